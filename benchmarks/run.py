@@ -0,0 +1,209 @@
+import argparse
+import os
+import sys
+import shutil
+import tempfile
+import time as clock
+import tracemalloc
+import numpy as np
+import pandas as pd
+
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'src'))
+
+from PyQt5.QtWidgets import QApplication
+from PyQt5.QtCore import Qt, QCoreApplication
+from synthetic import grid_size, write_synthetic, write_observed
+from colours import colour_table
+import ui
+from map import MapCanvas
+from models import ModelLoader
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def peak_rss():
+    if resource is None:
+        return np.nan
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale / 1024 ** 2
+
+
+def measure(function, inputs, setup=None):
+    # Every input but the last is timed untraced, the last is traced for its peak allocation
+    seconds = 0
+    for item in inputs[:-1]:
+        if setup is not None:
+            setup()
+        start = clock.perf_counter()
+        function(item)
+        seconds += clock.perf_counter() - start
+
+    if setup is not None:
+        setup()
+    tracemalloc.start()
+    function(inputs[-1])
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return 1000 * seconds / max(len(inputs) - 1, 1), peak / 1024 ** 2
+
+
+def wait_for(condition, timeout=600):
+    start = clock.perf_counter()
+    while not condition():
+        if clock.perf_counter() - start > timeout:
+            raise RuntimeError('Timed out waiting for the viewer')
+        QApplication.processEvents()
+        clock.sleep(0.01)
+
+
+def spread(values, count):
+    return [values[i] for i in np.linspace(0, len(values) - 1, count).astype(int)]
+
+
+def fail(message):
+    raise RuntimeError(message)
+
+
+def run_case(library, repeat):
+    ui.QInputDialog.getText = lambda *args, **kwargs: ('Synthetic', True)
+    ui.QMessageBox.setText = lambda self, text: fail(text)
+    directory = os.path.dirname(library)
+    cache = os.path.join(directory, 'shetran-results-viewer-cache')
+    results = []
+
+    def record(name, timing):
+        results.append({'benchmark': name, 'time (ms)': timing[0], 'peak (MB)': timing[1]})
+
+    loaders = []
+
+    def load(_):
+        loader = ModelLoader(library, 'Synthetic', geometry=True)
+        loader.run()
+        loaders.append(loader)
+
+    record('ModelLoader.run', measure(load, range(repeat), lambda: shutil.rmtree(cache, ignore_errors=True)))
+    record('ModelLoader.run (cached geometry)', measure(load, range(repeat)))
+    table, features = loaders[-1].table, loaders[-1].features
+
+    app = ui.App(ui.parse_args(['-l', library, '--tiles', os.path.join(directory, 'tiles'), '--offline']))
+    wait_for(lambda: app.model is not None and not app.loaders)
+    QApplication.processEvents()
+
+    canvases = [MapCanvas(app) for _ in range(repeat)]
+    record('MapCanvas.add_elements', measure(lambda canvas: canvas.add_elements(table, *features), canvases))
+    for canvas in canvases:
+        canvas.deleteLater()
+
+    layer = app.mapCanvas.visible_layer
+    count = len(app.mapCanvas.visible_rows)
+
+    def set_colours(offset):
+        # Every element changes colour between calls. The page runs scripts in order, so the response to a
+        # second script means the recolour has finished there.
+        done = []
+        layer.set_colours((np.arange(count) + offset) % len(colour_table()))
+        layer.getJsResponse('0', done.append)
+        wait_for(lambda: done)
+
+    record('ElementLayer.set_colours', measure(set_colours, list(range(repeat))))
+
+    times = list(range(len(app.variable.times)))
+    record('MapCanvas.set_time', measure(lambda time: app.mapCanvas.set_time(time, app.variable),
+                                         spread(times, repeat)))
+
+    elements = [table.element_at(row) for row in spread(table.land_rows, 2 * repeat + 2)]
+
+    def update_data(element):
+        app.element = element
+        app.plotCanvas.update_data()
+        app.plotCanvas.draw()
+
+    record('PlotCanvas.update_data', measure(update_data, elements[:repeat]))
+
+    series = [write_observed(os.path.join(directory, 'observed_{}.csv'.format(i)), len(times),
+                             int((app.variable.times[1] - app.variable.times[0]) / pd.Timedelta(hours=1)), seed=i)
+              for i in range(repeat)]
+
+    def add_series(item):
+        app.element, app.droppedPath = item
+        app.add_series()
+
+    record('App.add_series', measure(add_series, list(zip(elements[repeat:2 * repeat], series))))
+
+    app.plotCanvas.set_time(app.variable.times[0], app.mapCanvas.norm)
+    app.plotCanvas.set_zoom(50)
+
+    def set_x_limits(time):
+        app.plotCanvas.time = pd.Timestamp(time)
+        app.plotCanvas.set_x_limits()
+        app.plotCanvas.draw()
+
+    record('PlotCanvas.set_x_limits', measure(set_x_limits, spread(app.variable.times, repeat)))
+
+    def calculate_nse(time):
+        app.plotCanvas.metrics.clear()
+        app.plotCanvas.calculate_nse()
+
+    record('PlotCanvas.calculate_nse', measure(calculate_nse, spread(app.variable.times, repeat)))
+
+    output = os.path.join(directory, 'download.csv')
+    ui.QFileDialog.getSaveFileName = lambda *args, **kwargs: (output, '')
+
+    def download_values(element):
+        app.element = element
+        app.download_values()
+
+    record('App.download_values', measure(download_values, elements[2 * repeat:]))
+
+    elements = len(table)
+    app.close()
+    app.deleteLater()
+    QApplication.processEvents()
+    return elements, results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time the viewer hot paths on synthetic SHETran results')
+    parser.add_argument('--elements', type=int, nargs='+', default=[1000, 10000],
+                        help='approximate element counts to generate')
+    parser.add_argument('--timesteps', type=int, nargs='+', default=[1000], help='timestep counts to generate')
+    parser.add_argument('--river-fraction', type=float, default=0.1, help='river links per land element')
+    parser.add_argument('--repeat', type=int, default=5, help='calls per benchmark, each with a different input')
+    parser.add_argument('--directory', help='keep generated models here and reuse them on later runs')
+    parser.add_argument('--output', help='also write the results to this CSV file')
+    arguments = parser.parse_args()
+
+    QCoreApplication.setAttribute(Qt.AA_ShareOpenGLContexts)
+    application = QApplication(sys.argv[:1])
+
+    root = arguments.directory or tempfile.mkdtemp(prefix='shetran-benchmarks-')
+    rows = []
+    try:
+        for elements in arguments.elements:
+            for timesteps in arguments.timesteps:
+                directory = os.path.join(root, '{}x{}'.format(elements, timesteps))
+                library = os.path.join(directory, 'Synthetic_LibraryFile.xml')
+                if not os.path.exists(library):
+                    print('Generating {} elements x {} timesteps'.format(elements, timesteps))
+                    write_synthetic(directory, *grid_size(elements, arguments.river_fraction), timesteps=timesteps,
+                                    river_fraction=arguments.river_fraction)
+
+                count, results = run_case(library, max(arguments.repeat, 2))
+                for result in results:
+                    rows.append({'elements': count, 'timesteps': timesteps, **result})
+                print(pd.DataFrame(results).to_string(index=False, float_format='{:.1f}'.format))
+                print('Peak process memory so far {:.0f} MB\n'.format(peak_rss()))
+    finally:
+        if arguments.directory is None:
+            shutil.rmtree(root, ignore_errors=True)
+
+    results = pd.DataFrame(rows)
+    if arguments.output:
+        results.to_csv(arguments.output, index=False)
+    print(results.set_index(['benchmark', 'elements', 'timesteps'])['time (ms)'].unstack([1, 2])
+          .reindex(results['benchmark'].unique()).to_string(float_format='{:.1f}'.format))
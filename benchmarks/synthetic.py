@@ -0,0 +1,124 @@
+import argparse
+import os
+import numpy as np
+import pandas as pd
+import h5py
+
+name = 'Synthetic'
+
+
+def grid_size(elements, river_fraction=0.1):
+    side = max(2, int(round(np.sqrt(elements / (1 + river_fraction)))))
+    return side, side
+
+
+def write_synthetic(directory, rows=50, columns=50, timesteps=365, river_fraction=0.1, step_hours=24, seed=0):
+    rng = np.random.RandomState(seed)
+    os.makedirs(directory, exist_ok=True)
+    ny, nx = rows + 2, columns + 2
+
+    land_mask = np.zeros((ny, nx), dtype=bool)
+    land_mask[1:-1, 1:-1] = True
+    n_land = land_mask.sum()
+    n_links = max(1, int(n_land * river_fraction))
+
+    link_cells = rng.choice(n_land, n_links, replace=False)
+    north_link = -np.ones((ny, nx), dtype=np.int32)
+    ii, jj = np.where(land_mask)
+    north_link[ii[link_cells], jj[link_cells]] = np.arange(1, n_links + 1)
+
+    square = -np.ones((ny, nx), dtype=np.int32)
+    square[land_mask] = np.arange(n_links + 1, n_links + n_land + 1)
+    n_elements = n_links + n_land
+
+    empty = -np.ones((ny, nx), dtype=np.int32)
+    number = np.stack([square, empty, empty, empty, empty, north_link, empty, empty, empty], axis=2)
+
+    elevation_grid = np.linspace(100, 10, nx)[None, :] + np.linspace(0, 50, ny)[:, None]
+    surf_elv = np.where(number != -1, elevation_grid[:, :, None], -1).astype(np.float32)
+
+    sv4 = np.repeat(np.repeat(square, 2, axis=0), 2, axis=1)
+    li, lj = np.where(north_link != -1)
+    sv4[2 * li, 2 * lj] = north_link[li, lj]
+    sv4[2 * li, 2 * lj + 1] = north_link[li, lj]
+
+    t = np.arange(timesteps, dtype=np.float32) * step_hours
+    phase = rng.uniform(0, 2 * np.pi, (ny, nx, 1)).astype(np.float32)
+
+    path = os.path.join(directory, 'output_{}_shegraph.h5'.format(name))
+    with h5py.File(path, 'w') as f:
+        maps = f.create_group('CATCHMENT_MAPS')
+        maps['SV4_elevation'] = np.where(sv4 != -1, 50, -1).astype(np.float32)
+        maps['palette1'] = np.zeros((256, 3), dtype=np.uint8)
+        f.create_group('CATCHMENT_SPREADSHEETS')['SV4_numbering'] = sv4
+        constants = f.create_group('CONSTANTS')
+        constants['centroid'] = np.zeros((ny, nx, 9), dtype=np.float32)
+        constants['grid_dxy'] = np.ones((ny, nx), dtype=np.float32)
+        constants['number'] = number
+        for key in ['r_span', 'soil_typ', 'spatial1', 'vert_thk']:
+            constants[key] = np.zeros((ny, nx, 9), dtype=np.float32)
+        constants['surf_elv'] = surf_elv
+
+        variables = f.create_group('VARIABLES')
+        ph_depth = variables.create_group('  1 ph_depth')
+        ovr_flow = variables.create_group('  2 ovr_flow')
+        for group, shape in [(ph_depth, (ny, nx, timesteps)), (ovr_flow, (n_elements, 4, timesteps))]:
+            group.create_dataset('value', shape, dtype=np.float32)
+            group['value'].attrs['units'] = np.array([b'm'])
+            group['time'] = t
+            group['time'].attrs['units'] = np.array([b'hour'])
+
+        # Rows are written one at a time so that long runs are never held in memory at once
+        for i in range(ny):
+            values = np.full((nx, timesteps), -1, dtype=np.float32)
+            if 0 < i < ny - 1:
+                values[1:-1] = 1.5 + np.sin(2 * np.pi * t / (365 * 24) + phase[i, 1:-1]) + \
+                    0.1 * rng.standard_normal((nx - 2, timesteps))
+            ph_depth['value'][i] = values
+        chunk = max(1, 2 ** 22 // (4 * timesteps))
+        for start in range(0, n_elements, chunk):
+            stop = min(start + chunk, n_elements)
+            flow = np.abs(rng.standard_normal((stop - start, 4, timesteps)).astype(np.float32))
+            flow[:max(0, min(stop, n_links) - start)] *= 10
+            ovr_flow['value'][start:stop] = flow
+
+    with open(os.path.join(directory, '{}_DEM.txt'.format(name)), 'w') as f:
+        f.write('ncols {}\nnrows {}\nxllcorner 400000\nyllcorner 500000\ncellsize 100\nNODATA_value -9999\n'.format(
+            columns, rows))
+        np.savetxt(f, elevation_grid[1:-1, 1:-1], fmt='%.1f')
+
+    with open(os.path.join(directory, 'output_{}_discharge_sim_regulartimestep.txt'.format(name)), 'w') as f:
+        f.write('discharge\n')
+        np.savetxt(f, np.abs(rng.standard_normal(timesteps * int(step_hours))) * 5, fmt='%.3f')
+
+    library = os.path.join(directory, '{}_LibraryFile.xml'.format(name))
+    with open(library, 'w') as f:
+        f.write('<ShetranInput>\n<CatchmentName>{}</CatchmentName>\n<DEMMeanFileName>{}_DEM.txt</DEMMeanFileName>\n'
+                '<StartDay>01</StartDay>\n<StartMonth>01</StartMonth>\n<StartYear>2000</StartYear>\n'
+                '<SimulatedDischargeTimestep>1</SimulatedDischargeTimestep>\n<SRID>EPSG:27700</SRID>\n'
+                '</ShetranInput>\n'.format(name, name))
+    return library
+
+
+def write_observed(path, timesteps=365, step_hours=24, seed=0):
+    rng = np.random.RandomState(seed)
+    times = pd.date_range('2000-01-01', periods=timesteps, freq='{}H'.format(step_hours))
+    values = 1.5 + np.sin(2 * np.pi * np.arange(timesteps) * step_hours / (365 * 24)) + \
+        0.2 * rng.standard_normal(timesteps)
+    pd.DataFrame({'times': times.strftime('%Y-%m-%dT%H:%M:%S'), 'values': values.round(3)}).to_csv(path, index=False)
+    return path
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write a synthetic SHETran library, DEM and HDF output')
+    parser.add_argument('directory', help='directory to write the model to')
+    parser.add_argument('--elements', type=int, default=2500, help='approximate number of land and river elements')
+    parser.add_argument('--timesteps', type=int, default=365)
+    parser.add_argument('--river-fraction', type=float, default=0.1, help='river links per land element')
+    parser.add_argument('--step-hours', type=int, default=24, help='hours between timesteps')
+    parser.add_argument('--seed', type=int, default=0)
+    arguments = parser.parse_args()
+
+    print(write_synthetic(arguments.directory, *grid_size(arguments.elements, arguments.river_fraction),
+                          timesteps=arguments.timesteps, river_fraction=arguments.river_fraction,
+                          step_hours=arguments.step_hours, seed=arguments.seed))
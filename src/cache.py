@@ -0,0 +1,114 @@
+from collections import OrderedDict
+import os
+from threading import Lock
+import numpy as np
+from tracing import span
+
+
+def size_of(value):
+    if hasattr(value, 'nbytes'):
+        return value.nbytes
+    if isinstance(value, (list, tuple)):
+        return sum(size_of(v) for v in value)
+    if hasattr(value, '__dict__'):
+        return sum(size_of(v) for v in vars(value).values())
+    return 64
+
+
+class LRUCache:
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.items = OrderedDict()
+        self.lock = Lock()
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.items
+
+    def __len__(self):
+        return len(self.items)
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.items:
+                return None
+            self.items.move_to_end(key)
+            return self.items[key][0]
+
+    def put(self, key, value):
+        size = size_of(value)
+        with self.lock:
+            if key in self.items:
+                self.size -= self.items.pop(key)[1]
+            if size > self.max_size:
+                return value
+            self.items[key] = (value, size)
+            self.size += size
+            while self.size > self.max_size:
+                _, (_, evicted) = self.items.popitem(last=False)
+                self.size -= evicted
+        return value
+
+    def discard(self, predicate):
+        with self.lock:
+            for key in [key for key in self.items if predicate(key)]:
+                self.size -= self.items.pop(key)[1]
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.size = 0
+
+
+class ElementCache:
+    def __init__(self, max_size, read=None):
+        self.cache = LRUCache(max_size)
+        self.read = read
+
+    def get(self, variable, element_number):
+        key = (variable.hdf.model, variable.name, element_number)
+        series = self.cache.get(key)
+        if series is None:
+            with span('get_element', variable=variable.name, element=element_number):
+                series = self.read(variable, element_number) if self.read else variable.get_element(element_number)
+            self.cache.put(key, series)
+        return series
+
+    def discard_model(self, model):
+        self.cache.discard(lambda key: key[0] is model)
+
+
+sidecar_directory = 'shetran-results-viewer-cache'
+
+
+def sidecar_path(model, name):
+    return model.path(os.path.join(sidecar_directory, '{}_{}'.format(model.catchment_name, name)))
+
+
+def source_stamp(*paths):
+    return np.array([value for path in paths for value in (os.path.getmtime(path), os.path.getsize(path))])
+
+
+def load_sidecar(path, *sources):
+    if not os.path.exists(path):
+        return None
+    try:
+        with np.load(path, allow_pickle=False) as f:
+            data = dict(f)
+    except Exception:
+        return None
+    stamp = data.pop('source_stamp', None)
+    if stamp is None or not np.array_equal(stamp, source_stamp(*sources)):
+        return None
+    return data
+
+
+def save_sidecar(path, sources, **arrays):
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.tmp', 'wb') as f:
+            np.savez(f, source_stamp=source_stamp(*sources), **arrays)
+        os.replace(path + '.tmp', path)
+    except OSError:
+        pass
@@ -0,0 +1,31 @@
+from matplotlib.cm import get_cmap
+from matplotlib.colors import Normalize, to_hex
+import numpy as np
+from settings import colormap
+
+table_size = 256
+tables = {}
+
+
+def colour_table(name=colormap):
+    if name not in tables:
+        cm = get_cmap(name, table_size)
+        tables[name] = [to_hex(colour) for colour in cm(np.arange(table_size))]
+    return tables[name]
+
+
+def get_norm(values):
+    if np.all(np.isnan(values)) or np.nanmin(values) == np.nanmax(values) == 0:
+        return Normalize(vmin=0, vmax=1)
+    return Normalize(vmin=np.nanmin(values), vmax=np.nanmax(values))
+
+
+def quantise(values, norm):
+    values = np.asarray(values, dtype=float)
+    if norm.vmax > norm.vmin:
+        scaled = (values - norm.vmin) / (norm.vmax - norm.vmin)
+    else:
+        scaled = np.zeros_like(values)
+    indices = np.clip(np.floor(scaled * table_size), 0, table_size - 1)
+    indices[np.isnan(values)] = -1
+    return indices.astype(np.int16)
@@ -0,0 +1,48 @@
+import os
+import numpy as np
+import pandas as pd
+from cache import sidecar_path, source_stamp, load_sidecar, save_sidecar
+from pyramid import resample
+from settings import discharge_binary_size
+
+
+def discharge_path(model):
+    return model.path('output_{}_discharge_sim_regulartimestep.txt'.format(model.catchment_name))
+
+
+def read_values(model):
+    path = discharge_path(model)
+    binary_path = sidecar_path(model, 'discharge.npz')
+    data = load_sidecar(binary_path, path)
+    if data is not None:
+        return data['values']
+    values = pd.read_csv(path).iloc[:, 0].values.astype(float)
+    if os.path.getsize(path) > discharge_binary_size * 1024 ** 2:
+        save_sidecar(binary_path, [path], values=values)
+    return values
+
+
+def read_discharge(model):
+    values = read_values(model)
+    return pd.Series(values, name='modelled',
+                     index=pd.date_range(start=model.start_date, periods=len(values),
+                                         freq='{}H'.format(model.get('SimulatedDischargeTimestep'))))
+
+
+class DischargeCache:
+    def __init__(self):
+        self.series = {}
+
+    def get(self, model, level=None):
+        stamp = source_stamp(discharge_path(model))
+        cached = self.series.get(model)
+        if cached is None or not np.array_equal(cached[0], stamp):
+            cached = (stamp, {None: read_discharge(model)})
+            self.series[model] = cached
+        levels = cached[1]
+        if level not in levels:
+            levels[level] = resample(levels[None], level)
+        return levels[level]
+
+    def discard_model(self, model):
+        self.series.pop(model, None)
@@ -0,0 +1,64 @@
+import warnings
+import numpy as np
+
+modes = ['Ensemble Mean', 'Ensemble Std', 'Ensemble Range', 'Ensemble Rank']
+
+
+def mismatch(variables):
+    first = variables[0].hdf
+    for variable in variables[1:]:
+        if not np.array_equal(variable.hdf.number.square, first.number.square) or \
+                not np.array_equal(variable.hdf.element_numbers, first.element_numbers):
+            return 'The loaded models have different element grids'
+        if not variable.times.equals(variables[0].times):
+            return 'The loaded models have different output times'
+    return None
+
+
+def member_values(variable, time):
+    values = variable.get_time(time)
+    if variable.name == 'table_elev':
+        values = variable.hdf.elevations[variable.hdf.land_elements-1] - values
+    return values
+
+
+def reduce(values, mode, selected=0):
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        if mode == 'Ensemble Mean':
+            return np.nanmean(values, axis=0)
+        if mode == 'Ensemble Std':
+            return np.nanstd(values, axis=0)
+        if mode == 'Ensemble Range':
+            return np.nanmax(values, axis=0) - np.nanmin(values, axis=0)
+        if mode == 'Ensemble Rank':
+            rank = (values < values[selected]).sum(axis=0) + 1.0
+            rank[np.isnan(values[selected])] = np.nan
+            return rank
+    raise ValueError('Unknown ensemble mode {}'.format(mode))
+
+
+def envelope(values, mode):
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        mean = np.nanmean(values, axis=0)
+        if mode == 'Ensemble Std':
+            std = np.nanstd(values, axis=0)
+            return mean, mean - std, mean + std
+        return mean, np.nanmin(values, axis=0), np.nanmax(values, axis=0)
+
+
+class Ensemble:
+    def __init__(self, variables, mode, selected=0):
+        self.variables = variables
+        self.mode = mode
+        self.selected = selected
+        self.variable = variables[selected]
+        self.hdf = self.variable.hdf
+        self.times = self.variable.times
+        self.name = '{} {}'.format(self.variable.name, mode)
+        self.models = tuple(variable.hdf.model for variable in variables)
+
+    def get_time(self, time):
+        values = np.stack([member_values(variable, time) for variable in self.variables])
+        return reduce(values, self.mode, self.selected)
@@ -0,0 +1,128 @@
+from threading import Condition
+import numpy as np
+from PyQt5.QtCore import QThread
+from shetranio.hdf import LandVariable, LayeredLandVariable, OverlandFlow, SurfaceDepth
+from cache import LRUCache
+from colours import get_norm, quantise
+from ensemble import Ensemble
+from tracing import span, traced
+
+
+class Frame:
+    def __init__(self, values, norm, colours):
+        self.values = values
+        self.norm = norm
+        self.colours = colours
+
+
+@traced
+def make_frame(values, norm=None):
+    if norm is None:
+        norm = get_norm(values)
+    return Frame(values, norm, quantise(values, norm))
+
+
+def read_frame(variable, time, difference=None, size=None, norm=None):
+    with span('get_time', variable=variable.name, time=time):
+        values = variable.get_time(time)
+        if difference is not None:
+            values -= difference.get_time(time)
+    if variable.name == 'table_elev':
+        values = variable.hdf.elevations[variable.hdf.land_elements-1] - values
+    return make_frame(values[:size], norm)
+
+
+@traced
+def read_time_chunk(variable, start, stop):
+    if isinstance(variable, LandVariable):
+        if isinstance(variable, LayeredLandVariable):
+            values = variable.values[:, :, 0, start:stop]
+        else:
+            values = variable.values[:, :, start:stop]
+        numbers = variable.hdf.number.square.flatten()
+        values = values.reshape(len(numbers), -1)[numbers != -1][np.argsort(numbers[numbers != -1])].T
+        values = values.astype(float)
+        values[values == -1] = np.nan
+        return values
+    if isinstance(variable, OverlandFlow):
+        return np.abs(variable.values[:, :, start:stop]).max(axis=1).T
+    if isinstance(variable, SurfaceDepth):
+        return np.abs(variable.values[:, start:stop]).T
+    return np.stack([variable.get_time(time) for time in range(start, stop)])
+
+
+def read_frames(variable, start, stop, difference=None, size=None):
+    values = read_time_chunk(variable, start, stop)
+    if difference is not None:
+        values = values - read_time_chunk(difference, start, stop)
+    if variable.name == 'table_elev':
+        values = variable.hdf.elevations[variable.hdf.land_elements-1] - values
+    return values[:, :size]
+
+
+class FrameCache:
+    def __init__(self, max_size):
+        self.cache = LRUCache(max_size)
+
+    @staticmethod
+    def key(variable, time, difference=None, norm=None):
+        if isinstance(variable, Ensemble):
+            sources = variable.models
+        else:
+            sources = (difference.hdf.model,) if difference is not None else ()
+        return (variable.hdf.model, variable.name, sources, time,
+                (norm.vmin, norm.vmax) if norm is not None else None)
+
+    def __contains__(self, key):
+        return key in self.cache
+
+    def get(self, variable, time, difference=None, size=None, norm=None):
+        key = self.key(variable, time, difference, norm)
+        frame = self.cache.get(key)
+        if frame is None:
+            frame = self.cache.put(key, read_frame(variable, time, difference, size, norm))
+        return frame
+
+    def discard_model(self, model):
+        self.cache.discard(lambda key: model == key[0] or model in key[2])
+
+
+class Prefetcher(QThread):
+    def __init__(self, frames, radius, parent=None):
+        QThread.__init__(self, parent)
+        self.frames = frames
+        self.radius = radius
+        self.pending = None
+        self.stopped = False
+        self.condition = Condition()
+
+    def request(self, variable, time, difference=None, size=None, norm=None, step=None):
+        with self.condition:
+            self.pending = (variable, time, difference, size, norm, step)
+            self.condition.notify()
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+        self.wait()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.pending is None and not self.stopped:
+                    self.condition.wait()
+                if self.stopped:
+                    return
+                variable, time, difference, size, norm, step = self.pending
+                self.pending = None
+
+            if step is None:
+                times = [time + sign * offset for offset in range(1, self.radius + 1) for sign in [1, -1]]
+            else:
+                times = [time + step * offset for offset in range(1, self.radius + 1)]
+            times = [t for t in times if 0 <= t < len(variable.times)]
+            for t in times:
+                if self.pending is not None or self.stopped:
+                    break
+                self.frames.get(variable, t, difference, size, norm)
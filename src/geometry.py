@@ -0,0 +1,187 @@
+from shetranio.hdf import Geometries
+import numpy as np
+from cache import sidecar_path, load_sidecar, save_sidecar
+
+LAND = 0
+RIVER = 1
+BANK = 2
+
+
+class Element:
+    default_weight = 0.1
+
+    def __init__(self, table, row):
+        self.table = table
+        self.row = row
+
+    @property
+    def number(self):
+        return int(self.table.numbers[self.row])
+
+    @property
+    def elevation(self):
+        return float(self.table.elevations[self.row])
+
+    @property
+    def location(self):
+        return tuple(self.table.centroids[self.row].tolist())
+
+    @property
+    def is_river(self):
+        return bool(self.table.kinds[self.row] == RIVER)
+
+
+class SpatialIndex:
+    def __init__(self, bounds, rows, tolerance=0):
+        self.rows = rows
+        bounds = bounds[rows]
+        self.xmin = np.minimum(bounds[:, 0], bounds[:, 2])
+        self.xmax = np.maximum(bounds[:, 0], bounds[:, 2])
+        self.ymin = np.minimum(bounds[:, 1], bounds[:, 3])
+        self.ymax = np.maximum(bounds[:, 1], bounds[:, 3])
+        if len(rows) == 0:
+            return
+
+        self.origin = self.xmin.min(), self.ymin.min()
+        sizes = np.maximum(self.xmax - self.xmin, self.ymax - self.ymin)
+        self.cell_size = np.median(sizes) if np.median(sizes) > 0 else 1
+        self.tolerance = tolerance * self.cell_size
+
+        x0, y0 = self.cell(self.xmin, self.ymin)
+        x1, y1 = self.cell(self.xmax, self.ymax)
+        self.shape = x1.max() + 1, y1.max() + 1
+
+        # Each element is listed in every cell its bounds overlap, walking the cells of an element with k
+        heights = y1 - y0 + 1
+        counts = (x1 - x0 + 1) * heights
+        members = np.repeat(np.arange(len(rows)), counts)
+        k = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        cells = (x0[members] + k // heights[members]) * self.shape[1] + y0[members] + k % heights[members]
+        order = np.argsort(cells, kind='stable')
+        self.members = members[order]
+        self.starts = np.searchsorted(cells[order], np.arange(self.shape[0] * self.shape[1] + 1))
+
+    def cell(self, x, y):
+        return (np.floor((x - self.origin[0]) / self.cell_size).astype(int),
+                np.floor((y - self.origin[1]) / self.cell_size).astype(int))
+
+    def find(self, x, y):
+        if len(self.rows) == 0:
+            return None
+        cx, cy = self.cell(x, y)
+        radius = int(np.ceil(self.tolerance / self.cell_size))
+        candidates = [self.members[self.starts[i * self.shape[1] + j]:self.starts[i * self.shape[1] + j + 1]]
+                      for i in range(max(cx - radius, 0), min(cx + radius + 1, self.shape[0]))
+                      for j in range(max(cy - radius, 0), min(cy + radius + 1, self.shape[1]))]
+        if not candidates:
+            return None
+        candidates = np.concatenate(candidates)
+        if len(candidates) == 0:
+            return None
+        dx = np.maximum(0, np.maximum(self.xmin[candidates] - x, x - self.xmax[candidates]))
+        dy = np.maximum(0, np.maximum(self.ymin[candidates] - y, y - self.ymax[candidates]))
+        distances = np.hypot(dx, dy)
+        best = np.argmin(distances)
+        if distances[best] > self.tolerance:
+            return None
+        return self.rows[candidates[best]]
+
+
+class ElementTable:
+    def __init__(self, numbers, kinds, bounds, centroids, elevations):
+        visible = kinds != BANK
+        self.numbers = numbers[visible]
+        self.kinds = kinds[visible]
+        self.bounds = bounds[visible]
+        self.centroids = centroids[visible]
+        self.elevations = elevations[visible]
+
+        self.rows = np.full(self.numbers.max() + 1, -1)
+        self.rows[self.numbers] = np.arange(len(self.numbers))
+        self.land_rows = np.flatnonzero(self.kinds == LAND)
+        self.river_rows = np.flatnonzero(self.kinds == RIVER)
+        self.land_index = SpatialIndex(self.bounds, self.land_rows)
+        self.river_index = SpatialIndex(self.bounds, self.river_rows, tolerance=0.5)
+
+    def __len__(self):
+        return len(self.numbers)
+
+    def __contains__(self, number):
+        return 0 <= number < len(self.rows) and self.rows[number] >= 0
+
+    def row(self, number):
+        if number not in self:
+            raise KeyError(number)
+        return int(self.rows[number])
+
+    def element(self, number):
+        return Element(self, self.row(number))
+
+    def element_at(self, row):
+        return Element(self, int(row))
+
+    def find(self, x, y, is_river=False):
+        row = (self.river_index if is_river else self.land_index).find(x, y)
+        return None if row is None else self.element_at(row)
+
+    def features(self, rows):
+        return [{'type': 'Feature',
+                 'geometry': {'type': 'Polygon',
+                              'coordinates': [[[x1, y1], [x1, y2], [x2, y2], [x2, y1], [x1, y1]]]},
+                 'properties': {'number': number}}
+                for number, (x1, y1, x2, y2) in zip(self.numbers[rows].tolist(), self.bounds[rows].tolist())]
+
+
+def reproject(model, progress=None, cancelled=None):
+    geoms = Geometries(model.hdf, model.dem, srs=model.srid)
+    numbers = np.asarray(model.hdf.element_numbers)[:len(geoms)]
+
+    banks = np.concatenate((
+        model.hdf.number.north_bank,
+        model.hdf.number.west_bank,
+        model.hdf.number.east_bank,
+        model.hdf.number.south_bank))
+
+    kinds = np.full(len(numbers), RIVER, dtype=np.int8)
+    kinds[np.isin(numbers, model.hdf.land_elements)] = LAND
+    kinds[np.isin(numbers, banks)] = BANK
+
+    bounds = np.zeros((len(numbers), 4))
+    prog = 0
+    for i, geom in enumerate(geoms):
+        if i == len(numbers):
+            break
+        if kinds[i] == BANK:
+            continue
+        (x1, y1), _, (x2, y2) = geom['coordinates'][0][:3]
+        bounds[i] = x1, y1, x2, y2
+        if int(100 * i / len(geoms)) > prog:
+            prog = int(100 * i / len(geoms))
+            if cancelled is not None and cancelled():
+                return None
+            if progress is not None:
+                progress(prog)
+
+    centroids = np.stack([(bounds[:, 1] + bounds[:, 3]) / 2, (bounds[:, 0] + bounds[:, 2]) / 2], axis=1).round(3)
+
+    return {'numbers': numbers, 'kinds': kinds, 'bounds': bounds, 'centroids': centroids,
+            'elevations': model.hdf.elevations[numbers - 1], 'srid': np.array(str(model.srid))}
+
+
+def read_geometry(model, progress=None, cancelled=None):
+    path = sidecar_path(model, 'geometry.npz')
+    sources = [model.dem.path, model.hdf.path]
+    data = load_sidecar(path, *sources)
+    if data is not None and str(data['srid']) == str(model.srid):
+        return data
+    data = reproject(model, progress, cancelled)
+    if data is not None:
+        save_sidecar(path, sources, **data)
+    return data
+
+
+def build_table(model, progress=None, cancelled=None):
+    data = read_geometry(model, progress, cancelled)
+    if data is None:
+        return None
+    return ElementTable(data['numbers'], data['kinds'], data['bounds'], data['centroids'], data['elevations'])
@@ -5,6 +5,7 @@ from matplotlib.figure import Figure
 from matplotlib.colors import Normalize
 import numpy as np
 from settings import colormap
+from tracing import traced
 
 
 class LegendCanvas(FigureCanvas):
@@ -27,6 +28,13 @@ class LegendCanvas(FigureCanvas):
         self.fig.patch.set_visible(False)
         self.setStyleSheet("background-color:transparent;")
 
+    @traced
     def set_time(self, norm):
+        if (self.sm.norm.vmin, self.sm.norm.vmax) == (norm.vmin, norm.vmax):
+            return
         self.sm.set_norm(norm)
-        self.draw()
+        self.draw_idle()
+
+    @traced
+    def draw(self):
+        super().draw()
@@ -1,15 +1,15 @@
-from shetranio.hdf import Geometries
-import numpy as np
-from matplotlib.cm import get_cmap
-from settings import colormap
-from matplotlib.colors import Normalize, to_hex
+from colours import colour_table
+from frames import make_frame
+from geometry import Element
+from tracing import traced
 from pyqtlet import MapWidget
 from PyQt5.QtWidgets import QFrame
 from PyQt5.QtCore import pyqtSignal
 from PyQt5.QtWidgets import QVBoxLayout, QWidget
 from pyqtlet import L
+from pyqtlet.leaflet.core import Evented
 import json
-from PyQt5.QtCore import pyqtSlot, QJsonValue
+from PyQt5.QtCore import pyqtSlot
 
 
 class Group(L.featureGroup):
@@ -20,10 +20,71 @@ class Group(L.featureGroup):
         self.runJavaScript("{}.setStyle({})".format(self.jsName, json.dumps(style)))
 
 
+class Pointer(Evented):
+    jsName = 'pointer'
+    moved = pyqtSignal(float, float)
+
+    @pyqtSlot(float, float)
+    def _signal(self, lat, lng):
+        self.moved.emit(lat, lng)
+
+    def __init__(self):
+        super().__init__()
+        self._createJsObject('{hover: false}')
+        self.runJavaScript(
+            "map.on('click', function(e) {"
+            "    if (!pointer.hover) channelObjects.pointerObject._signal(e.latlng.lat, e.latlng.lng)"
+            "});"
+            "map.on('mousemove', function(e) {"
+            "    if (pointer.hover) channelObjects.pointerObject._signal(e.latlng.lat, e.latlng.lng)"
+            "});")
+
+    def set_hover(self, hover):
+        self.runJavaScript('pointer.hover = {}'.format('true' if hover else 'false'))
+
+
+class ElementLayer(L.featureGroup):
+    def __init__(self, features, style, colours):
+        self.features = features
+        self.style = style
+        self.colours = colours
+        super().__init__()
+
+    def _initJs(self):
+        self._createJsObject('L.geoJSON({}, {{style: {}, interactive: false}})'.format(
+            json.dumps({'type': 'FeatureCollection', 'features': self.features}), json.dumps(self.style)))
+        self.runJavaScript(
+            "{name}.elements = {{}};"
+            "{name}.ordered = [];"
+            "{name}.eachLayer(function(layer) {{"
+            "    {name}.elements[layer.feature.properties.number] = layer;"
+            "    {name}.ordered.push(layer);"
+            "}});"
+            "{name}.colours = {colours};"
+            "{name}.setColours = function(indices) {{"
+            "    for (var i = 0; i < indices.length; i++) {{"
+            "        var layer = {name}.ordered[i];"
+            "        if (layer._colourIndex === indices[i]) continue;"
+            "        layer._colourIndex = indices[i];"
+            "        if (indices[i] < 0) layer.setStyle({{fillOpacity: 0}});"
+            "        else layer.setStyle({{fillColor: {name}.colours[indices[i]], fillOpacity: {opacity}}});"
+            "    }}"
+            "}};"
+            .format(name=self.jsName, colours=json.dumps(self.colours), opacity=self.style['fillOpacity']))
+        self.features = None
+
+    @traced
+    def update_style(self, number, style):
+        self.runJavaScript("{}.elements[{}].setStyle({})".format(self.jsName, number, json.dumps(style)))
+
+    @traced
+    def set_colours(self, indices):
+        self.runJavaScript("{}.setColours([{}])".format(self.jsName, ','.join(map(str, indices.tolist()))))
+
+
 class MapCanvas(QFrame):
     clickedElement = pyqtSignal(object)
     loaded = pyqtSignal()
-    progress = pyqtSignal(float)
 
     def __init__(self, app):
 
@@ -45,18 +106,23 @@ class MapCanvas(QFrame):
 
         self.map = L.map(self.mapWidget)
         self.map.setZoom(10)
+        L.tileLayer(app.tile_server.url).addTo(self.map)
 
         self.group = Group()
         self.group.addTo(self.map)
+        self.pointer = Pointer()
+        self.pointer.moved.connect(self.find_element)
+        self.hover = False
         self.setLineWidth(10)
         self.setFrameShape(QFrame.StyledPanel)
 
         self.clickedElement.connect(self.select_element)
         self.element = None
-        self.elements = []
-        self.river_elements = []
-        self.land_elements = []
-        self.visible_elements = None
+        self.table = None
+        self.land_layer = None
+        self.river_layer = None
+        self.visible_layer = None
+        self.visible_rows = None
         self.norm = None
         self.mapWidget.setAcceptDrops(False)
 
@@ -67,119 +133,79 @@ class MapCanvas(QFrame):
 
         self.group.getJsResponse('{}.getBounds()'.format(self.group.jsName), _pan_to)
 
-    def add_data(self, model):
-
-        L.tileLayer('http://{s}.tile.osm.org/{z}/{x}/{y}.png').addTo(self.map)
-
-        geoms = Geometries(model.hdf, model.dem, srs=model.srid)
-
-        banks = np.concatenate((
-            model.hdf.number.north_bank,
-            model.hdf.number.west_bank,
-            model.hdf.number.east_bank,
-            model.hdf.number.south_bank))
-
-        prog = 0
-        for geom, number in zip(geoms, model.hdf.element_numbers):
-            if number in banks:
-                continue
-            coords = [[y, x] for (x, y) in geom['coordinates'][0]]
-            lat = np.mean([coord[0] for coord in coords[:-1]]).round(3)
-            lon = np.mean([coord[1] for coord in coords[:-1]]).round(3)
-            elevation = model.hdf.elevations[number-1]
-            element = Element(coords, number, elevation, (lat, lon), self.clickedElement)
-            self.elements.append(element)
-            if number in model.hdf.land_elements:
-                self.land_elements.append(element)
-            else:
-                self.river_elements.append(element)
-            self.group.addLayer(element)
-            prog += 100/len(geoms)
-            self.progress.emit(prog)
+    @traced
+    def add_elements(self, table, land_features, river_features):
+        self.table = table
+
+        style = {'weight': Element.default_weight, 'fillOpacity': 0.8}
+        self.land_layer = ElementLayer(land_features, style, colour_table())
+        self.river_layer = ElementLayer(river_features, style, colour_table())
+        self.group.addLayer(self.land_layer)
+        self.visible_layer = self.land_layer
+        self.visible_rows = self.table.land_rows
 
         self.pan_to()
 
         self.loaded.emit()
 
-    def set_onclick(self):
-        for element in self.elements:
-            element.onclick()
+    def bounds(self):
+        x1, y1, x2, y2 = self.table.bounds.T
+        return (min(y1.min(), y2.min()), min(x1.min(), x2.min())), (max(y1.max(), y2.max()), max(x1.max(), x2.max()))
 
-    def set_onhover(self):
-        for element in self.elements:
-            element.onhover()
+    def set_hover(self, hover):
+        self.hover = hover
+        self.pointer.set_hover(hover)
+
+    def find_element(self, lat, lng):
+        if self.table is None:
+            return
+        element = self.table.find(lng, lat, self.visible_layer is self.river_layer)
+        if element is None:
+            return
+        if self.hover and self.element is not None and element.number == self.element.number:
+            return
+        self.clickedElement.emit(element)
 
     def select_element(self, element):
         if self.element is not None:
-            self.element.update_style({'weight': self.element.default_weight})
+            self.layer_of(self.element).update_style(self.element.number, {'weight': self.element.default_weight})
 
         if self.app.disable_clicking:
             return
 
         self.element = element
-        element.update_style({'weight': 3})
+        self.layer_of(element).update_style(element.number, {'weight': 3})
+
+    def layer_of(self, element):
+        return self.river_layer if element.is_river else self.land_layer
+
+    def show_layer(self, layer, rows):
+        self.group.removeLayer(self.visible_layer)
+        self.group.addLayer(layer)
+        self.visible_layer = layer
+        self.visible_rows = rows
+        self.select_element(self.table.element_at(rows[0]))
 
     def show_land(self):
-        for element in self.river_elements:
-            self.group.removeLayer(element)
-        for element in self.land_elements:
-            self.group.addLayer(element)
-        self.visible_elements = self.land_elements
-        self.select_element(self.land_elements[0])
+        self.show_layer(self.land_layer, self.table.land_rows)
 
     def show_rivers(self):
-        for element in self.land_elements:
-            self.group.removeLayer(element)
-        for element in self.river_elements:
-            self.group.addLayer(element)
-        self.visible_elements = self.river_elements
-        self.select_element(self.river_elements[0])
+        self.show_layer(self.river_layer, self.table.river_rows)
 
     def set_elements_enabled(self):
-        for element in self.elements:
-            element.runJavaScript("{}.interactive = false".format(element.jsName))
-
-
-    def set_time(self, time, variable, difference=None):
-        values = variable.get_time(time)
-        if difference is not None:
-            values -= difference.get_time(time)
-        if variable.name == 'table_elev':
-            values = variable.hdf.elevations[variable.hdf.land_elements-1] - values
-
-        cm = get_cmap(colormap)
-        if np.all(values == 0):
-            self.norm = Normalize(vmin=0, vmax=1)
-        else:
-            self.norm = Normalize(vmin=min(values), vmax=max(values))
-        values = cm(self.norm(values))
-        for element, value in zip(self.visible_elements, values):
-            element.update_style({'fillColor': to_hex(value)})
-
-
-class Element(L.polygon):
-    default_weight = 0.1
-
-    @pyqtSlot(QJsonValue)
-    def _signal(self):
-        self.signal.emit(self)
-
-    def __init__(self, shape, element_number, elevation, location, signal):
-        super().__init__(shape, {'weight': self.default_weight, 'fillOpacity': 0.8})
-        self.signal = signal
-        self.number = element_number
-        self.elevation = elevation
-        self.location = location
-        self.setProperty('element_number', element_number)
-        self._connectEventToSignal('click', '_signal')
-
-    def onclick(self):
-        self.runJavaScript("{}.off()".format(self.jsName))
-        self._connectEventToSignal('click', '_signal')
-
-    def onhover(self):
-        self.runJavaScript("{}.off()".format(self.jsName))
-        self._connectEventToSignal('mouseover', '_signal')
+        for layer in [self.land_layer, self.river_layer]:
+            layer.runJavaScript("{}.options.interactive = false".format(layer.jsName))
+
+
+    @traced
+    def set_time(self, time, variable, difference=None, norm=None):
+        self.set_frame(self.app.frames.get(variable, time, difference, len(self.visible_rows), norm))
+
+    @traced
+    def set_values(self, values, norm=None):
+        self.set_frame(make_frame(values[:len(self.visible_rows)], norm))
+
+    def set_frame(self, frame):
+        self.norm = frame.norm
+        self.visible_layer.set_colours(frame.colours)
 
-    def update_style(self, style):
-        self.runJavaScript("{}.setStyle({})".format(self.jsName, json.dumps(style)))
@@ -0,0 +1,45 @@
+import numpy as np
+import pandas as pd
+
+names = ['NSE', 'KGE', 'RMSE', 'PBIAS', 'r']
+
+
+class Metrics:
+    def __init__(self, modelled, observed):
+        join = pd.merge_asof(modelled.rename('modelled').to_frame(), observed.rename('observed').to_frame(),
+                             left_index=True, right_index=True)
+        join = join[join.modelled.notnull() & join.observed.notnull()]
+        self.index = join.index.values
+        m = join.modelled.values.astype(float)
+        o = join.observed.values.astype(float)
+        self.offset = o.mean() if len(o) else 0
+        m = m - self.offset
+        o = o - self.offset
+        self.sums = np.zeros((6, len(o) + 1))
+        for row, values in enumerate([m, o, m * m, o * o, m * o, (m - o) ** 2]):
+            np.cumsum(values, out=self.sums[row, 1:])
+
+    def window(self, start=None, end=None):
+        i = 0 if start is None else np.searchsorted(self.index, np.datetime64(start), 'left')
+        j = len(self.index) if end is None else np.searchsorted(self.index, np.datetime64(end), 'right')
+        n = j - i
+        if n < 2:
+            return dict.fromkeys(names, np.nan)
+        sm, so, smm, soo, smo, sse = self.sums[:, j] - self.sums[:, i]
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean_m = sm / n
+            mean_o = so / n
+            var_m = max(smm / n - mean_m ** 2, 0)
+            var_o = max(soo / n - mean_o ** 2, 0)
+            covariance = smo / n - mean_m * mean_o
+            r = covariance / np.sqrt(var_m * var_o)
+            alpha = np.sqrt(var_m / var_o)
+            beta = (mean_m + self.offset) / (mean_o + self.offset)
+            return {
+                'NSE': 1 - sse / (n * var_o),
+                'KGE': 1 - np.sqrt((r - 1) ** 2 + (alpha - 1) ** 2 + (beta - 1) ** 2),
+                'RMSE': np.sqrt(sse / n),
+                'PBIAS': 100 * (sm - so) / (so + n * self.offset),
+                'r': r,
+            }
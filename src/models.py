@@ -0,0 +1,93 @@
+import traceback
+from PyQt5.QtCore import QThread, pyqtSignal
+
+
+def add_water_table(model):
+    from shetranio.hdf import LandVariable
+
+    table_elev = LandVariable(model.hdf, 'ph_depth')
+    table_elev.long_name = 'Water Table Elevation (m)'
+    table_elev.name = 'table_elev'
+    model.hdf.variables.append(table_elev)
+    model.hdf.spatial_variables.append(table_elev)
+
+
+def load_model(library_path, name=None):
+    from shetranio.model import Model
+
+    model = Model(library_path, name=name)
+    add_water_table(model)
+    return model
+
+
+def get_variable(model, name):
+    for variable in model.hdf.spatial_variables:
+        if name in (variable.name, variable.long_name):
+            return variable
+    raise ValueError('{} has no spatial variable called {}'.format(model.library, name))
+
+
+class ModelLoader(QThread):
+    progress = pyqtSignal(object, float, str)
+    loaded = pyqtSignal(object)
+    failed = pyqtSignal(object, str)
+
+    def __init__(self, library_path, name, geometry=False, parent=None):
+        QThread.__init__(self, parent)
+        self.library_path = library_path
+        self.name = name
+        self.build_geometry = geometry
+        self.model = None
+        self.table = None
+        self.features = None
+        self.cancelled = False
+        if geometry:
+            self.stages = [('Opening model', 30), ('Adding variables', 5), ('Building geometry', 60),
+                           ('Building map layer', 5)]
+        else:
+            self.stages = [('Opening model', 90), ('Adding variables', 10)]
+        self.stage = None
+
+    def cancel(self):
+        self.cancelled = True
+
+    def set_stage(self, name, progress=0):
+        done = 0
+        for stage, weight in self.stages:
+            if stage == name:
+                self.stage = name
+                self.progress.emit(self, done + weight * progress / 100, name)
+                return
+            done += weight
+
+    def run(self):
+        try:
+            # shetranio and its GDAL and HDF5 bindings are imported here, off the main thread
+            from shetranio.model import Model
+            from geometry import build_table
+
+            self.set_stage('Opening model')
+            # shetranio parses the library, reads the DEM and loads the HDF file in this one call, so a cancel
+            # only takes effect once it returns
+            model = Model(self.library_path, name=self.name)
+            if self.cancelled:
+                return
+
+            self.set_stage('Adding variables')
+            add_water_table(model)
+            if self.cancelled:
+                return
+
+            if self.build_geometry:
+                self.set_stage('Building geometry')
+                self.table = build_table(model, lambda p: self.set_stage('Building geometry', p),
+                                         lambda: self.cancelled)
+                if self.table is None:
+                    return
+                self.set_stage('Building map layer')
+                self.features = self.table.features(self.table.land_rows), self.table.features(self.table.river_rows)
+
+            self.model = model
+            self.loaded.emit(self)
+        except Exception:
+            self.failed.emit(self, traceback.format_exc())
@@ -0,0 +1,102 @@
+import json
+import os
+import numpy as np
+import pandas as pd
+from cache import sidecar_directory, source_stamp, load_sidecar, save_sidecar
+from settings import observed_time_format
+
+time_formats = ['%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M', '%Y-%m-%d %H:%M', '%Y-%m-%d',
+                '%d/%m/%Y %H:%M:%S', '%d/%m/%Y %H:%M', '%d/%m/%Y', '%d-%m-%Y %H:%M:%S', '%d-%m-%Y %H:%M',
+                '%d-%m-%Y', '%Y/%m/%d %H:%M:%S', '%Y/%m/%d %H:%M', '%Y/%m/%d']
+
+
+def detect_format(times, sample_size=100):
+    sample = pd.Series(times[:sample_size]).str.strip()
+    for time_format in time_formats:
+        try:
+            pd.to_datetime(sample, format=time_format)
+            return time_format
+        except (ValueError, TypeError):
+            continue
+    return None
+
+
+def parse_times(times, time_format=None):
+    time_format = time_format or detect_format(times)
+    if time_format is None:
+        return pd.DatetimeIndex(pd.to_datetime(times, dayfirst=True))
+    return pd.DatetimeIndex(pd.to_datetime(pd.Series(times).str.strip(), format=time_format))
+
+
+def cache_path(path):
+    return os.path.join(os.path.dirname(os.path.abspath(path)), sidecar_directory,
+                        '{}.npz'.format(os.path.basename(path)))
+
+
+def read_series(path, time_format=None):
+    data = load_sidecar(cache_path(path), path)
+    if data is None or str(data.get('time_format')) != (time_format or ''):
+        frame = pd.read_csv(path, usecols=[0, 1], skipinitialspace=True, dtype={0: str})
+        times = parse_times(frame.iloc[:, 0].values, time_format)
+        values = pd.to_numeric(frame.iloc[:, 1], errors='coerce').values.astype(float)
+        order = np.argsort(times.values, kind='stable')
+        data = {'times': times.values.astype(np.int64)[order], 'values': values[order],
+                'time_format': np.array(time_format or '')}
+        save_sidecar(cache_path(path), [path], **data)
+    return pd.Series(data['values'], index=pd.to_datetime(data['times']), name='observed')
+
+
+class ObservedStore:
+    def __init__(self, index_path=None):
+        self.index_path = index_path
+        self.gauges = {}
+        self.series = {}
+        if index_path is not None and os.path.exists(index_path):
+            try:
+                with open(index_path) as f:
+                    self.gauges = json.load(f)
+            except (OSError, ValueError):
+                self.gauges = {}
+
+    def save(self):
+        if self.index_path is None:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+            with open(self.index_path, 'w') as f:
+                json.dump(self.gauges, f, indent=2)
+        except OSError:
+            pass
+
+    def read(self, path, time_format=None, start=None, end=None):
+        time_format = time_format or observed_time_format
+        stamp = source_stamp(path)
+        cached = self.series.get((path, time_format))
+        if cached is None or not np.array_equal(cached[0], stamp):
+            series = read_series(path, time_format).rename(os.path.basename(path))
+            cached = (stamp, {(None, None): series})
+            self.series[(path, time_format)] = cached
+        windows = cached[1]
+        if (start, end) not in windows:
+            windows[(start, end)] = windows[(None, None)].loc[start:end]
+        return windows[(start, end)]
+
+    def add(self, key, path, time_format=None):
+        path = os.path.abspath(path)
+        series = self.read(path, time_format)
+        gauges = self.gauges.setdefault(str(key), [])
+        if path not in [gauge['path'] for gauge in gauges]:
+            gauges.append({'path': path, 'format': time_format})
+            self.save()
+        return series
+
+    def remove(self, key):
+        if self.gauges.pop(str(key), None) is not None:
+            self.save()
+
+    def __contains__(self, key):
+        return str(key) in self.gauges
+
+    def get(self, key, start=None, end=None):
+        return [self.read(gauge['path'], gauge['format'], start, end)
+                for gauge in self.gauges.get(str(key), []) if os.path.exists(gauge['path'])]
@@ -4,8 +4,100 @@ from matplotlib.colors import Normalize
 from matplotlib.cm import ScalarMappable
 import pandas as pd
 import numpy as np
-from PyQt5.QtWidgets import QSizePolicy
-from settings import colormap
+from threading import Condition
+from PyQt5.QtWidgets import QSizePolicy, QTableWidget, QTableWidgetItem, QAbstractItemView
+from PyQt5.QtCore import QThread, pyqtSignal
+from settings import colormap, metrics_cache_size
+from cache import LRUCache
+from metrics import Metrics, names as metric_names
+from ensemble import envelope, modes as ensemble_modes
+from pyramid import resample, frequencies
+from tracing import traced
+
+
+def decimate(series, xmin=None, xmax=None, pixels=1000):
+    x = series.index.values
+    start = 0 if xmin is None else max(np.searchsorted(x, np.datetime64(xmin), 'left') - 1, 0)
+    stop = len(x) if xmax is None else min(np.searchsorted(x, np.datetime64(xmax), 'right') + 1, len(x))
+    if stop - start <= 4 * pixels:
+        return series.iloc[start:stop]
+
+    size = int(np.ceil((stop - start) / pixels))
+    values = np.full(pixels * size, np.nan)
+    values[:stop - start] = series.values[start:stop]
+    values = values.reshape(pixels, size)
+    offsets = np.arange(pixels) * size
+    low = np.where(np.isnan(values), np.inf, values).argmin(axis=1) + offsets
+    high = np.where(np.isnan(values), -np.inf, values).argmax(axis=1) + offsets
+    index = np.unique(np.concatenate([[0, stop - start - 1], low, high]))
+    return series.iloc[start + index[index < stop - start]]
+
+
+def decimate_envelope(lower, upper, xmin=None, xmax=None, pixels=1000):
+    # Both bounds are kept at the extremes of either, so the filled band has one shared set of times
+    index = decimate(lower, xmin, xmax, pixels).index.union(decimate(upper, xmin, xmax, pixels).index)
+    return lower.loc[index], upper.loc[index]
+
+
+class MetricsTable(QTableWidget):
+    def __init__(self):
+        super().__init__(0, len(metric_names) + 1)
+        self.setHorizontalHeaderLabels(['Model'] + metric_names)
+        self.verticalHeader().hide()
+        self.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        self.setMaximumHeight(120)
+        self.hide()
+
+    def set_metrics(self, rows):
+        self.setVisible(len(rows) > 0)
+        self.setRowCount(len(rows))
+        for i, (name, values) in enumerate(rows):
+            self.setItem(i, 0, QTableWidgetItem(name))
+            for j, metric in enumerate(metric_names):
+                self.setItem(i, j + 1, QTableWidgetItem('{:.2f}'.format(values[metric])))
+
+
+class SeriesWorker(QThread):
+    loaded = pyqtSignal(object, object)
+
+    def __init__(self, cache, parent=None):
+        QThread.__init__(self, parent)
+        self.cache = cache
+        self.pending = None
+        self.stopped = False
+        self.condition = Condition()
+
+    def request(self, element, variables):
+        with self.condition:
+            self.pending = (element, variables)
+            self.condition.notify()
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+        self.wait()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.pending is None and not self.stopped:
+                    self.condition.wait()
+                if self.stopped:
+                    return
+                element, variables = self.pending
+                self.pending = None
+
+            values = []
+            try:
+                for variable in variables:
+                    if self.pending is not None or self.stopped:
+                        break
+                    values.append(self.cache.get(variable, element.number))
+            except ValueError:
+                continue
+            if len(values) == len(variables) and self.pending is None:
+                self.loaded.emit(element, values)
 
 
 class PlotCanvas(FigureCanvas):
@@ -30,107 +122,166 @@ class PlotCanvas(FigureCanvas):
                                    QSizePolicy.Expanding)
 
         self.lines = []
+        self.full = {}
         self.model_values = []
         self.observed = None
+        self.observed_lines = []
+        self.envelope = None
+        self.envelope_bounds = None
+        self.ensemble_line = None
         self.time = None
+        self.cursor = None
+        self.background = None
+        self.x_extent = None
+        self.xmin = None
+        self.xmax = None
         self.zoom_level = 0
+        self.metrics = LRUCache(metrics_cache_size * 1024 ** 2)
+        self.metrics_series = None
+        self.metrics_table = MetricsTable()
         self.setAcceptDrops(True)
+        self.mpl_connect('draw_event', self.on_draw)
 
     def clear_plot(self):
         for line in self.lines:
             self.axes.lines.remove(line)
         self.lines = []
-        if self.observed is not None:
-            self.axes.lines.remove(self.observed)
-            self.observed = None
+        self.full = {}
+        self.model_values = []
+        self.ensemble_line = None
+        self.xmin = self.xmax = None
+        if self.envelope is not None:
+            self.envelope.remove()
+            self.envelope = None
+        self.envelope_bounds = None
+        for line in self.observed_lines:
+            self.axes.lines.remove(line)
+        self.observed_lines = []
+        self.observed = None
 
-    def plot_observed(self):
+    def pixels(self):
+        return max(int(self.axes.bbox.width), 100)
 
-        self.observed = None
+    def decimated(self, series):
+        return decimate(series, self.xmin, self.xmax, self.pixels())
 
-        if self.app.series is None:
-            return
+    def plot_series(self, series, **kwargs):
+        decimated = self.decimated(series)
+        line = self.axes.plot(decimated.index, decimated.values, **kwargs)[0]
+        self.full[line] = series
+        return line
 
-        if self.app.resampleCheckBox.isChecked() and (self.app.series.index[1] -
-                                                      self.app.series.index[0]) < pd.Timedelta(days=28):
-            series = self.app.series.resample('1M').mean()
-        else:
-            series = self.app.series
+    def set_line_data(self, line, series):
+        self.full[line] = series
+        decimated = self.decimated(series)
+        line.set_data(decimated.index, decimated.values)
 
-        series.plot(ax=self.axes, label='Series', color='C{}'.format(len(self.app.variables)))
-        self.observed = self.axes.lines[-1]
+    def plot_observed(self):
+        for i, series in enumerate(self.app.gauges):
+            series = resample(series, self.app.resolutionDropDown.currentText())
+            self.observed_lines.append(self.plot_series(series, label=series.name,
+                                                        color='C{}'.format(len(self.app.variables) + i)))
+        self.observed = self.observed_lines[0] if self.observed_lines else None
 
     def plot_difference(self):
         var1 = self.app.variables[self.app.modelDropDown.currentIndex()]
         var2 = self.app.variables[self.app.differenceDropDown.currentIndex()]
 
-        difference = pd.Series(var1.get_element(self.app.element.number) - var2.get_element(self.app.element.number),
+        difference = pd.Series(self.app.element_cache.get(var1, self.app.element.number) -
+                               self.app.element_cache.get(var2, self.app.element.number),
                                index=var1.times)
-        if self.app.resampleCheckBox.isChecked() and (difference.index[1] - difference.index[0]) < pd.Timedelta(days=28):
-            difference = difference.resample('1M').mean()
-        difference.plot(ax=self.axes, color='C0', label='{} - {}'.format(var1.hdf.model.name, var2.hdf.model.name))
-        self.lines.append(self.axes.lines[-1])
+        difference = resample(difference, self.app.resolutionDropDown.currentText())
+        self.lines.append(self.plot_series(difference, color='C0',
+                                           label='{} - {}'.format(var1.hdf.model.name, var2.hdf.model.name)))
+
+    def model_series(self, var, values=None):
+        level = self.app.resolutionDropDown.currentText()
+        pyramid = self.app.get_pyramid(var) if level in frequencies else None
+        if pyramid is not None and level in pyramid:
+            try:
+                return pyramid.series(level, self.app.element.number)
+            except ValueError:
+                pass
+
+        if values is None:
+            values = self.app.element_cache.get(var, self.app.element.number)
+        s = pd.Series(values, index=var.times, name='modelled')
+        if self.app.variable.name == 'table_elev':
+            s = self.app.element.elevation - s
+        return resample(s, level)
 
     def plot_models(self):
         self.model_values = []
         for i, var in enumerate(self.app.variables):
-
-            s = pd.Series(var.get_element(self.app.element.number), index=var.times, name='modelled')
-            if self.app.variable.name == 'table_elev':
-                s = self.app.element.elevation - s
-
-            if self.app.resampleCheckBox.isChecked() and (s.index[1] - s.index[0]) < pd.Timedelta(days=28):
-                s = s.resample('1M').mean()
-
-            s.plot(color='C{}'.format(i), ax=self.axes,
-                   label=var.hdf.model.name)
-
-            self.lines.append(self.axes.lines[-1])
+            s = self.model_series(var)
+            self.lines.append(self.plot_series(s, color='C{}'.format(i), label=var.hdf.model.name))
             self.model_values.append(s)
 
+        if self.app.mapModeDropDown.currentText() in ensemble_modes:
+            self.plot_envelope()
+
         if self.app.variable.name == 'table_elev':
             self.axes.axhline(self.app.element.elevation, color='brown')
 
             self.lines.append(self.axes.lines[-1])
 
+    def plot_envelope(self):
+        values = pd.concat(self.model_values, axis=1)
+        centre, lower, upper = envelope(values.values.T, self.app.mapModeDropDown.currentText())
+        self.envelope_bounds = pd.Series(lower, index=values.index), pd.Series(upper, index=values.index)
+        self.draw_envelope()
+        if self.ensemble_line is None:
+            self.ensemble_line = self.plot_series(pd.Series(centre, index=values.index), color='black',
+                                                  linestyle='--', label='Ensemble Mean')
+            self.lines.append(self.ensemble_line)
+        else:
+            self.set_line_data(self.ensemble_line, pd.Series(centre, index=values.index))
+
+    def draw_envelope(self):
+        lower, upper = decimate_envelope(*self.envelope_bounds, self.xmin, self.xmax, self.pixels())
+        if self.envelope is not None:
+            self.envelope.remove()
+        self.envelope = self.axes.fill_between(lower.index, lower.values, upper.values, color='grey', alpha=0.3,
+                                               linewidth=0, label='Ensemble')
+
     def plot_discharge(self):
         self.model_values = []
 
         for i, var in enumerate(self.app.variables):
-            s = pd.read_csv(var.hdf.model.path('output_{}_discharge_sim_regulartimestep.txt'.format(
-                var.hdf.model.catchment_name)), squeeze=True)
-
-            s.name = 'modelled'
-
-            s.index = pd.date_range(start=var.hdf.model.start_date, periods=len(s),
-                                    freq='{}H'.format(var.hdf.model.get('SimulatedDischargeTimestep')))
-
-            if self.app.resampleCheckBox.isChecked():
-                s = s.resample('1M').mean()
-
-            s.plot(color='C{}'.format(i), ax=self.axes, label=var.hdf.model.name)
-
-            self.lines.append(self.axes.lines[-1])
+            s = self.app.discharge.get(var.hdf.model, self.app.resolutionDropDown.currentText())
+            self.lines.append(self.plot_series(s, color='C{}'.format(i), label=var.hdf.model.name))
             self.model_values.append(s)
 
+    @traced
     def calculate_nse(self):
         if self.observed is None:
+            self.metrics_table.set_metrics([])
             return
 
-        for model_values, line, variable in zip(self.model_values, self.lines, self.app.variables):
-
-            join = pd.merge_asof(model_values, self.app.series.resample('1M').mean() if self.app.resampleCheckBox.isChecked() else self.app.series, left_index=True, right_index=True, )[self.xmin:self.xmax]
+        if self.app.series is not self.metrics_series:
+            self.metrics.clear()
+            self.metrics_series = self.app.series
 
-            join = join[join.modelled.notnull() & join.observed.notnull()]
-
-            ns = 1 - (((join.modelled - join.observed) ** 2).sum() / ((join.observed - join.observed.mean()) ** 2).sum())
+        level = self.app.resolutionDropDown.currentText()
+        element = 'outlet' if self.app.outletCheckBox.isChecked() else self.app.element.number
+        observed = None
+        rows = []
+        for model_values, line, variable in zip(self.model_values, self.lines, self.app.variables):
+            key = (element, variable.hdf.model, self.app.variable.name, level)
+            metrics = self.metrics.get(key)
+            if metrics is None:
+                if observed is None:
+                    observed = resample(self.app.series, level)
+                metrics = self.metrics.put(key, Metrics(model_values, observed))
 
-            line.set_label('{} ({:.2f})'.format(variable.hdf.model.name, ns))
+            values = metrics.window(self.xmin, self.xmax)
+            line.set_label('{} ({:.2f})'.format(variable.hdf.model.name, values['NSE']))
+            rows.append((variable.hdf.model.name, values))
 
         self.legend = self.axes.legend()
+        self.metrics_table.set_metrics(rows)
 
-
-
+    @traced
     def update_data(self):
 
         self.clear_plot()
@@ -153,9 +304,7 @@ class PlotCanvas(FigureCanvas):
             elif self.app.variable.name != 'ph_depth' and self.axes.yaxis_inverted():
                 self.axes.invert_yaxis()
 
-            self.axes.set_title('Element {} - {:.2f} m {}'.format(self.app.element.number,
-                                                                  self.app.element.elevation,
-                                                                  self.app.element.location))
+            self.set_title()
 
             self.axes.set_ylabel(self.app.variables[0].long_name)
 
@@ -169,35 +318,78 @@ class PlotCanvas(FigureCanvas):
             self.legend = self.axes.legend()
         elif self.legend:
             self.legend.remove()
+
+        x_values = self.full[self.lines[0]].index
+        self.x_extent = (pd.Timestamp(x_values.min()), pd.Timestamp(x_values.max()))
+        self.set_x_limits()
+
+    def set_title(self):
+        self.axes.set_title('Element {} - {:.2f} m {}'.format(self.app.element.number,
+                                                              self.app.element.elevation,
+                                                              self.app.element.location))
+
+    @traced
+    def update_element(self, values):
+        if self.app.outletCheckBox.isChecked() or self.app.differenceCheckBox.isChecked() or \
+                len(self.model_values) != len(values) or self.observed is not None or \
+                (self.app.observed is not None and self.app.element.number in self.app.observed):
+            self.update_data()
+            return
+
+        self.xmin = self.xmax = None
+        for i, (line, var) in enumerate(zip(self.lines, self.app.variables)):
+            s = self.model_series(var, values[i])
+            self.set_line_data(line, s)
+            self.model_values[i] = s
+        if self.envelope is not None:
+            self.plot_envelope()
+        if self.app.variable.name == 'table_elev':
+            self.lines[-1].set_ydata([self.app.element.elevation] * 2)
+
+        self.set_title()
+        self.axes.relim()
+        self.axes.autoscale_view()
         self.set_x_limits()
 
+    @traced
+    def draw(self):
+        super().draw()
+
     def set_backgroud(self):
         self.axes.patch.set_visible(False)
 
+    def on_draw(self, event):
+        if self.cursor is None:
+            return
+        self.background = self.copy_from_bbox(self.axes.bbox)
+        self.axes.draw_artist(self.cursor)
+
     def set_time(self, time, norm):
-        if self.time in self.axes.lines:
-            self.axes.lines.remove(self.time)
-        self.time = self.axes.axvline(time, color='black', linewidth=0.8)
-        self.set_backgroud()
+        self.time = pd.Timestamp(time)
         self.sm.set_norm(norm)
-        self.set_x_limits()
+        if self.cursor is None:
+            self.cursor = self.axes.axvline(self.time, color='black', linewidth=0.8, animated=True)
+        else:
+            self.cursor.set_xdata([self.time, self.time])
+
+        if self.background is not None and self.get_window() == (self.xmin, self.xmax):
+            self.restore_region(self.background)
+            self.axes.draw_artist(self.cursor)
+            self.blit(self.axes.bbox)
+        else:
+            self.set_x_limits()
 
     def set_zoom(self, value):
         self.zoom_level = value
         self.set_x_limits()
 
-    def set_x_limits(self):
-        if not self.time:
-            return
-        x_values = self.lines[0].get_xdata()
-        minx = min(x_values).to_timestamp()
-        maxx = max(x_values).to_timestamp()
+    def get_window(self):
+        minx, maxx = self.x_extent
         duration = maxx - minx
         interval = duration / 100
         duration = (duration - interval * self.zoom_level) / 2
-        time = self.time.get_xdata()[0]
-        xmin = time - duration
-        xmax = time + duration
+        xmin = self.time - duration
+        xmax = self.time + duration
 
         if xmin < minx:
             diff = minx - xmin
@@ -209,10 +401,21 @@ class PlotCanvas(FigureCanvas):
             xmax -= diff
             xmin -= diff
 
-        self.axes.set_xlim(xmin, xmax)
+        return xmin, xmax
 
-        self.xmin = xmin
-        self.xmax = xmax
+    @traced
+    def set_x_limits(self):
+        if self.time is None or self.x_extent is None:
+            return
+        self.xmin, self.xmax = self.get_window()
+        self.background = None
+        self.set_backgroud()
+        self.axes.set_xlim(self.xmin, self.xmax)
+        for line, series in self.full.items():
+            decimated = self.decimated(series)
+            line.set_data(decimated.index, decimated.values)
+        if self.envelope_bounds is not None:
+            self.draw_envelope()
 
         self.calculate_nse()
-        self.draw()
+        self.draw_idle()
@@ -0,0 +1,180 @@
+import os
+import numpy as np
+import pandas as pd
+from PyQt5.QtCore import QThread, pyqtSignal
+from cache import sidecar_path, load_sidecar, save_sidecar
+from frames import read_frames
+from stats import chunks
+from store import row_numbers
+from settings import stats_chunk_size
+from tracing import traced
+
+levels = [('Daily', 'D'), ('Monthly', 'M'), ('Seasonal', 'Q-NOV'), ('Annual', 'A')]
+frequencies = dict(levels)
+
+
+@traced
+def resample(series, level):
+    if level not in frequencies:
+        return series
+    periods = series.index.to_period(frequencies[level])
+    if len(periods.unique()) == len(series):
+        return series
+    return series.resample(frequencies[level]).mean()
+
+
+class Pyramid:
+    def __init__(self, numbers, arrays):
+        self.numbers = numbers
+        self.arrays = arrays
+        self.order = np.argsort(numbers)
+
+    def __contains__(self, level):
+        return '{}_codes'.format(level) in self.arrays
+
+    def column(self, number):
+        index = np.searchsorted(self.numbers, number, sorter=self.order)
+        if index == len(self.numbers) or self.numbers[self.order[index]] != number:
+            raise ValueError('Element {} is not in the time pyramid'.format(number))
+        return self.order[index]
+
+    def times(self, level):
+        return pd.to_datetime(self.arrays['{}_times'.format(level)])
+
+    def series(self, level, number, statistic='mean'):
+        return pd.Series(self.arrays['{}_{}'.format(level, statistic)][:, self.column(number)],
+                         index=self.times(level), name='modelled')
+
+    def frame(self, level, time, statistic='mean'):
+        return self.arrays['{}_{}'.format(level, statistic)][self.arrays['{}_codes'.format(level)][time]]
+
+
+def period_levels(times):
+    found = []
+    for level, frequency in levels:
+        codes, periods = pd.factorize(times.to_period(frequency))
+        if len(periods) < len(times):
+            found.append((level, codes.astype(np.int32), periods.end_time.normalize().values.astype(np.int64)))
+    return found
+
+
+def index_path(variable):
+    return sidecar_path(variable.hdf.model, '{}_pyramid.npz'.format(variable.name))
+
+
+def array_path(variable, name):
+    return sidecar_path(variable.hdf.model, '{}_pyramid_{}.npy'.format(variable.name, name))
+
+
+def build(variable, chunk_size=stats_chunk_size, progress=None, cancelled=None, save=False):
+    # Only the latest period of each level is accumulated in memory, finished periods go straight to the outputs
+    times = pd.DatetimeIndex(variable.times)
+    numbers = row_numbers(variable)
+    found = period_levels(times)
+    arrays = {}
+    outputs = {}
+    for level, codes, period_times in found:
+        arrays['{}_codes'.format(level)] = codes
+        arrays['{}_times'.format(level)] = period_times
+        for statistic in ['mean', 'min', 'max']:
+            name = '{}_{}'.format(level, statistic)
+            shape = (len(period_times), len(numbers))
+            if save:
+                os.makedirs(os.path.dirname(array_path(variable, name)), exist_ok=True)
+                outputs[name] = np.lib.format.open_memmap(array_path(variable, name) + '.tmp', mode='w+',
+                                                          dtype=np.float32, shape=shape)
+            else:
+                outputs[name] = np.empty(shape, dtype=np.float32)
+
+    def write(level, rows, total, count, minimum, maximum):
+        outputs['{}_mean'.format(level)][rows] = np.where(count > 0, total / np.maximum(count, 1), np.nan)
+        outputs['{}_min'.format(level)][rows] = minimum
+        outputs['{}_max'.format(level)][rows] = maximum
+
+    unfinished = {}
+    for start, stop in chunks(0, len(times) if found else 0, chunk_size):
+        if cancelled is not None and cancelled():
+            if save:
+                outputs.clear()
+                for name in ['{}_{}'.format(level, statistic) for level, _, _ in found
+                             for statistic in ['mean', 'min', 'max']]:
+                    os.remove(array_path(variable, name) + '.tmp')
+            return None
+        values = read_frames(variable, start, stop).astype(float)
+        valid = ~np.isnan(values)
+        for level, codes, _ in found:
+            codes = codes[start:stop]
+            starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]])
+            runs = codes[starts]
+            total = np.add.reduceat(np.where(valid, values, 0), starts, axis=0)
+            count = np.add.reduceat(valid.astype(np.int64), starts, axis=0)
+            minimum = np.fmin.reduceat(values, starts, axis=0)
+            maximum = np.fmax.reduceat(values, starts, axis=0)
+            if level in unfinished:
+                code, *previous = unfinished.pop(level)
+                if code == runs[0]:
+                    total[0] += previous[0]
+                    count[0] += previous[1]
+                    minimum[0] = np.fmin(minimum[0], previous[2])
+                    maximum[0] = np.fmax(maximum[0], previous[3])
+                else:
+                    write(level, code, *previous)
+            write(level, slice(runs[0], runs[-1]), total[:-1], count[:-1], minimum[:-1], maximum[:-1])
+            unfinished[level] = (runs[-1], total[-1], count[-1], minimum[-1], maximum[-1])
+        if progress is not None:
+            progress(100 * stop / len(times))
+    for level, (code, *previous) in unfinished.items():
+        write(level, code, *previous)
+
+    if not save:
+        arrays.update(outputs)
+        return Pyramid(numbers, arrays)
+    for array in outputs.values():
+        array.flush()
+    names = list(outputs)
+    outputs.clear()
+    for name in names:
+        os.replace(array_path(variable, name) + '.tmp', array_path(variable, name))
+    save_sidecar(index_path(variable), [variable.hdf.path] + [array_path(variable, name) for name in names],
+                 numbers=numbers, **arrays)
+    for name in names:
+        arrays[name] = np.load(array_path(variable, name), mmap_mode='r')
+    return Pyramid(numbers, arrays)
+
+
+def load_pyramid(variable):
+    names = ['{}_{}'.format(level, statistic) for level, _, _ in period_levels(pd.DatetimeIndex(variable.times))
+             for statistic in ['mean', 'min', 'max']]
+    if not all(os.path.exists(array_path(variable, name)) for name in names):
+        return None
+    data = load_sidecar(index_path(variable), variable.hdf.path, *[array_path(variable, name) for name in names])
+    if data is None:
+        return None
+    for name in names:
+        data[name] = np.load(array_path(variable, name), mmap_mode='r')
+    return Pyramid(data.pop('numbers'), data)
+
+
+class PyramidWorker(QThread):
+    progress = pyqtSignal(float)
+    built = pyqtSignal(object, object)
+
+    def __init__(self, key, variable, parent=None):
+        QThread.__init__(self, parent)
+        self.key = key
+        self.variable = variable
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def run(self):
+        pyramid = load_pyramid(self.variable)
+        if pyramid is None:
+            try:
+                pyramid = build(self.variable, progress=self.progress.emit, cancelled=lambda: self.cancelled,
+                                save=True)
+            except OSError:
+                pyramid = build(self.variable, progress=self.progress.emit, cancelled=lambda: self.cancelled)
+        if pyramid is not None:
+            self.built.emit(self.key, pyramid)
@@ -0,0 +1,163 @@
+import argparse
+import os
+import shutil
+import subprocess
+import tempfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+from matplotlib.colors import Normalize, to_rgba
+from matplotlib.cm import ScalarMappable
+from colours import colour_table
+from frames import make_frame, read_frames
+from models import load_model, get_variable
+from settings import colormap, stats_chunk_size
+
+renderer = None
+
+
+def visible_numbers(model, variable):
+    if not variable.is_river:
+        return model.hdf.land_elements
+    n = model.hdf.number
+    banks = np.concatenate([n.north_bank, n.west_bank, n.east_bank, n.south_bank], axis=None)
+    numbers = model.hdf.element_numbers
+    return numbers[~np.isin(numbers, banks) & ~np.isin(numbers, model.hdf.land_elements)]
+
+
+def element_raster(model, variable):
+    numbers = visible_numbers(model, variable)
+    # Land values are drawn on the element grid, river links on the finer grid that includes them
+    grid = model.hdf.sv4_numbering if variable.is_river else model.hdf.number.square
+    lookup = np.full(max(grid.max(), numbers.max()) + 1, -1)
+    lookup[numbers] = np.arange(len(numbers))
+    index = np.where(grid > 0, lookup[np.maximum(grid, 0)], -1)
+
+    dem = model.dem
+    cell_size = dem.cell_size / (grid.shape[0] / model.hdf.surface_elevation.square.shape[0])
+    x = dem.x_lower_left - dem.cell_size
+    y = dem.y_lower_left - dem.cell_size
+    return index, (x, x + grid.shape[1] * cell_size, y, y + grid.shape[0] * cell_size), len(numbers)
+
+
+class FrameRenderer:
+    def __init__(self, index, extent, vmin=None, vmax=None, dpi=100):
+        self.index = index
+        self.extent = extent
+        self.norm = Normalize(vmin=vmin, vmax=vmax) if vmin is not None else None
+        self.dpi = dpi
+        self.colours = np.array([to_rgba(colour) for colour in colour_table()] + [(0, 0, 0, 0)])
+
+    def render(self, values, title, path):
+        frame = make_frame(values, self.norm)
+        image = self.colours[np.where(self.index >= 0, frame.colours[self.index], -1)]
+
+        fig = Figure(figsize=(7, 7))
+        FigureCanvasAgg(fig)
+        axes = fig.add_subplot(111)
+        axes.imshow(image, extent=self.extent, interpolation='nearest')
+        axes.set_axis_off()
+        axes.set_title(title)
+        sm = ScalarMappable(cmap=colormap, norm=frame.norm)
+        sm.set_array(np.array([]))
+        fig.colorbar(sm, ax=axes, orientation='horizontal', fraction=0.05, pad=0.05)
+        fig.savefig(path, dpi=self.dpi, bbox_inches='tight')
+
+
+def start_renderer(*args):
+    global renderer
+    renderer = FrameRenderer(*args)
+
+
+def render_frame(task):
+    values, title, path = task
+    renderer.render(values, title, path)
+    return path
+
+
+def get_time_index(times, value):
+    if value is None:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        return int(times.searchsorted(pd.Timestamp(value)))
+
+
+def render(library, variable_name, start=None, stop=None, step=1, output='frames', processes=None,
+           fixed_scale=False, fps=10, dpi=100):
+    model = load_model(library)
+    variable = get_variable(model, variable_name)
+    times = pd.DatetimeIndex(variable.times)
+    start = get_time_index(times, start) or 0
+    stop = get_time_index(times, stop)
+    stop = len(times) if stop is None else min(stop, len(times))
+
+    vmin = vmax = None
+    if fixed_scale:
+        from stats import load_stats, reduce, save_stats
+        stats = load_stats(variable)
+        if stats is None:
+            stats = reduce(variable, size=len(visible_numbers(model, variable)))
+            save_stats(variable, stats)
+        vmin, vmax = stats.norm.vmin, stats.norm.vmax
+    index, extent, size = element_raster(model, variable)
+
+    video = output.lower().endswith('.mp4')
+    directory = tempfile.mkdtemp() if video else output
+    os.makedirs(directory, exist_ok=True)
+    frames = list(range(start, stop, step))
+    per_block = max(1, stats_chunk_size // step)
+
+    # Frames are read here in blocks and sent to the workers, so the HDF file is only opened once.
+    # The next block is read while the previous one renders.
+    pending = deque()
+    done = 0
+
+    def wait(futures):
+        nonlocal done
+        for future in futures:
+            future.result()
+            done += 1
+            print('\r{}/{}'.format(done, len(frames)), end='', flush=True)
+
+    with ProcessPoolExecutor(processes, initializer=start_renderer,
+                             initargs=(index, extent, vmin, vmax, dpi)) as pool:
+        for block in range(0, len(frames), per_block):
+            block_frames = frames[block:block + per_block]
+            values = read_frames(variable, block_frames[0], block_frames[-1] + 1, size=size)[::step]
+            pending.append([pool.submit(render_frame, (values[i], '{} - {}'.format(variable.long_name, times[time]),
+                                                       os.path.join(directory, 'frame_{:06d}.png'.format(block + i))))
+                            for i, time in enumerate(block_frames)])
+            if len(pending) > 1:
+                wait(pending.popleft())
+        while pending:
+            wait(pending.popleft())
+    print()
+
+    if video:
+        subprocess.run(['ffmpeg', '-y', '-loglevel', 'error', '-framerate', str(fps),
+                        '-i', os.path.join(directory, 'frame_%06d.png'),
+                        '-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2', '-pix_fmt', 'yuv420p', output], check=True)
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Render SHETran result maps to PNG frames or an MP4 without a display')
+    parser.add_argument('library', help='library file of the model')
+    parser.add_argument('variable', help='variable name, e.g. ph_depth or table_elev')
+    parser.add_argument('--start', help='first timestep index or date')
+    parser.add_argument('--stop', help='timestep index or date to stop before')
+    parser.add_argument('--step', type=int, default=1, help='timesteps between frames')
+    parser.add_argument('--output', default='frames', help='directory for PNG frames, or a .mp4 file')
+    parser.add_argument('--processes', type=int, help='number of rendering processes')
+    parser.add_argument('--fixed-scale', action='store_true', help='use the whole-run range for every frame')
+    parser.add_argument('--fps', type=int, default=10, help='frame rate of the MP4')
+    parser.add_argument('--dpi', type=int, default=100)
+    arguments = parser.parse_args()
+
+    render(arguments.library, arguments.variable, arguments.start, arguments.stop, arguments.step,
+           arguments.output, arguments.processes, arguments.fixed_scale, arguments.fps, arguments.dpi)
@@ -1 +1,21 @@
 colormap = 'RdYlGn'
+frame_cache_size = 256  # MB
+prefetch_frames = 10
+stats_chunk_size = 256  # timesteps
+element_cache_size = 128  # MB
+store_chunk_size = 1024  # timesteps
+metrics_cache_size = 64  # MB
+hover_latency = 50  # ms
+model_loaders = 2  # models opened at once, further models wait in a queue
+discharge_binary_size = 1  # MB, discharge files larger than this get a binary sidecar
+observed_time_format = None  # e.g. '%d/%m/%Y %H:%M', detected from the first rows when None
+trace_buffer_size = 1000000  # events kept in memory for --trace
+tile_url = 'https://tile.openstreetmap.org/{z}/{x}/{y}.png'
+tile_bulk_download = False  # only set for a tile_url whose provider allows bulk downloads
+tile_cache_path = None  # MBTiles file or tile directory, ~/.shetran-results-viewer/tiles.mbtiles when None
+tile_cache_size = 512  # MB
+tile_prefetch_zooms = (8, 14)  # lowest and highest zoom levels saved by Cache Basemap
+tile_prefetch_limit = 20000  # tiles
+tile_policy_zoom = 13  # without tile_bulk_download, Cache Basemap saves at most tile_policy_limit tiles
+tile_policy_limit = 250  # from this zoom level up, as the OpenStreetMap tile usage policy requires
+tile_retry_interval = 60  # s, before asking the tile server again after a network failure
@@ -0,0 +1,152 @@
+import numpy as np
+from PyQt5.QtCore import QThread, pyqtSignal
+from matplotlib.colors import Normalize
+from cache import sidecar_path, load_sidecar, save_sidecar
+from frames import read_frames
+from settings import stats_chunk_size
+
+percentiles = np.array([1, 5, 25, 50, 75, 95, 99])
+bins = 100
+
+
+class Stats:
+    def __init__(self, min, max, mean, percentiles, global_min, global_max, global_mean, global_percentiles):
+        self.min = min
+        self.max = max
+        self.mean = mean
+        self.percentiles = percentiles
+        self.global_min = global_min
+        self.global_max = global_max
+        self.global_mean = global_mean
+        self.global_percentiles = global_percentiles
+
+    @property
+    def norm(self):
+        if np.isnan(self.global_min) or self.global_min == self.global_max:
+            return Normalize(vmin=0, vmax=1)
+        return Normalize(vmin=self.global_min, vmax=self.global_max)
+
+    def percentile(self, q):
+        return self.percentiles[:, list(percentiles).index(q)]
+
+
+def chunks(start, stop, chunk_size):
+    for chunk_start in range(start, stop, chunk_size):
+        yield chunk_start, min(chunk_start + chunk_size, stop)
+
+
+def histogram_percentiles(histograms, lower, upper):
+    counts = histograms.sum(axis=1)
+    cumulative = np.cumsum(histograms, axis=1)
+    width = (upper - lower) / bins
+    result = np.full((len(histograms), len(percentiles)), np.nan)
+    for i, q in enumerate(percentiles):
+        target = q / 100 * counts
+        index = np.minimum((cumulative < target[:, None]).sum(axis=1), bins - 1)
+        rows = np.arange(len(histograms))
+        before = np.where(index > 0, cumulative[rows, index - 1], 0)
+        in_bin = histograms[rows, index]
+        fraction = np.where(in_bin > 0, (target - before) / np.maximum(in_bin, 1), 0)
+        result[:, i] = np.where(counts > 0, lower + (index + fraction) * width, np.nan)
+    return result
+
+
+def reduce(variable, start=0, stop=None, difference=None, size=None, chunk_size=stats_chunk_size,
+           progress=None, cancelled=None):
+    stop = len(variable.times) if stop is None else stop
+    minimum = maximum = total = count = None
+
+    for chunk_start, chunk_stop in chunks(start, stop, chunk_size):
+        if cancelled is not None and cancelled():
+            return None
+        values = read_frames(variable, chunk_start, chunk_stop, difference, size)
+        valid = ~np.isnan(values)
+        if minimum is None:
+            minimum = np.full(values.shape[1], np.inf)
+            maximum = np.full(values.shape[1], -np.inf)
+            total = np.zeros(values.shape[1])
+            count = np.zeros(values.shape[1], dtype=np.int64)
+        minimum = np.minimum(minimum, np.where(valid, values, np.inf).min(axis=0))
+        maximum = np.maximum(maximum, np.where(valid, values, -np.inf).max(axis=0))
+        total += np.where(valid, values, 0).sum(axis=0)
+        count += valid.sum(axis=0)
+        if progress is not None:
+            progress(50 * (chunk_stop - start) / (stop - start))
+
+    empty = count == 0
+    minimum[empty] = np.nan
+    maximum[empty] = np.nan
+    mean = np.where(empty, np.nan, total / np.maximum(count, 1))
+    global_min = np.nanmin(minimum) if not empty.all() else np.nan
+    global_max = np.nanmax(maximum) if not empty.all() else np.nan
+    global_mean = total.sum() / count.sum() if not empty.all() else np.nan
+
+    lower = np.where(empty, 0, minimum)
+    upper = np.where(empty | (maximum == minimum), lower + 1, maximum)
+    element_histograms = np.zeros((len(minimum), bins), dtype=np.int64)
+    global_upper = global_max if global_max > global_min else global_min + 1
+    global_histogram = np.zeros(bins, dtype=np.int64)
+    columns = np.arange(len(minimum)) * bins
+
+    for chunk_start, chunk_stop in chunks(start, stop, chunk_size):
+        if cancelled is not None and cancelled():
+            return None
+        values = read_frames(variable, chunk_start, chunk_stop, difference, size)
+        valid = ~np.isnan(values)
+        index = np.clip(((values - lower) / (upper - lower) * bins).astype(int, copy=False), 0, bins - 1)
+        element_histograms += np.bincount((columns + index)[valid],
+                                          minlength=len(minimum) * bins).reshape(len(minimum), bins)
+        global_histogram += np.histogram(values[valid], bins=bins, range=(global_min, global_upper))[0]
+        if progress is not None:
+            progress(50 + 50 * (chunk_stop - start) / (stop - start))
+
+    return Stats(minimum, maximum, mean, histogram_percentiles(element_histograms, lower, upper),
+                 global_min, global_max, global_mean,
+                 histogram_percentiles(global_histogram[None, :], np.array([global_min]),
+                                       np.array([global_upper]))[0])
+
+
+def load_stats(variable):
+    model = variable.hdf.model
+    data = load_sidecar(sidecar_path(model, '{}_stats.npz'.format(variable.name)), variable.hdf.path)
+    if data is None or not np.array_equal(data['percentile_levels'], percentiles):
+        return None
+    return Stats(data['min'], data['max'], data['mean'], data['percentiles'],
+                 float(data['global_min']), float(data['global_max']), float(data['global_mean']),
+                 data['global_percentiles'])
+
+
+def save_stats(variable, stats):
+    model = variable.hdf.model
+    save_sidecar(sidecar_path(model, '{}_stats.npz'.format(variable.name)), [variable.hdf.path],
+                 min=stats.min, max=stats.max, mean=stats.mean, percentiles=stats.percentiles,
+                 global_min=stats.global_min, global_max=stats.global_max, global_mean=stats.global_mean,
+                 global_percentiles=stats.global_percentiles, percentile_levels=percentiles)
+
+
+class StatsWorker(QThread):
+    progress = pyqtSignal(float)
+    calculated = pyqtSignal(object, object)
+
+    def __init__(self, key, variable, difference=None, size=None, parent=None):
+        QThread.__init__(self, parent)
+        self.key = key
+        self.variable = variable
+        self.difference = difference
+        self.size = size
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def run(self):
+        stats = None
+        if self.difference is None:
+            stats = load_stats(self.variable)
+        if stats is None:
+            stats = reduce(self.variable, difference=self.difference, size=self.size,
+                           progress=self.progress.emit, cancelled=lambda: self.cancelled)
+            if stats is not None and self.difference is None:
+                save_stats(self.variable, stats)
+        if stats is not None:
+            self.calculated.emit(self.key, stats)
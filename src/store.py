@@ -0,0 +1,158 @@
+import argparse
+import os
+from threading import Lock
+import numpy as np
+import pandas as pd
+from PyQt5.QtCore import QThread, pyqtSignal
+from shetranio.hdf import LandVariable, LayeredLandVariable, OverlandFlow, SurfaceDepth
+from cache import sidecar_path, source_stamp, load_sidecar, save_sidecar
+from stats import chunks
+from settings import store_chunk_size
+
+
+def source_name(variable):
+    return variable.variable.name.split(' ')[-1]
+
+
+def row_numbers(variable):
+    if isinstance(variable, LandVariable):
+        return np.sort(variable.hdf.number.square[variable.hdf.number.square != -1])
+    return variable.hdf.element_numbers[:variable.values.shape[0]]
+
+
+def read_element_chunk(variable, start, stop):
+    if isinstance(variable, LandVariable):
+        if isinstance(variable, LayeredLandVariable):
+            values = variable.values[:, :, 0, start:stop]
+        else:
+            values = variable.values[:, :, start:stop]
+        numbers = variable.hdf.number.square.flatten()
+        return values.reshape(len(numbers), -1)[numbers != -1][np.argsort(numbers[numbers != -1])]
+    if isinstance(variable, OverlandFlow):
+        return np.abs(variable.values[:, :, start:stop]).max(axis=1)
+    return variable.values[:, start:stop]
+
+
+def paths(model, name):
+    return (sidecar_path(model, '{}_elements.npy'.format(name)),
+            sidecar_path(model, '{}_elements_index.npz'.format(name)))
+
+
+def convert_variable(variable, progress=None, cancelled=None):
+    model = variable.hdf.model
+    values_path, index_path = paths(model, source_name(variable))
+    numbers = row_numbers(variable)
+    length = variable.values.shape[-1]
+    os.makedirs(os.path.dirname(values_path), exist_ok=True)
+
+    array = np.lib.format.open_memmap(values_path + '.tmp', mode='w+', dtype=variable.values.dtype,
+                                      shape=(len(numbers), length))
+    for start, stop in chunks(0, length, store_chunk_size):
+        if cancelled is not None and cancelled():
+            del array
+            os.remove(values_path + '.tmp')
+            return False
+        array[:, start:stop] = read_element_chunk(variable, start, stop)
+        if progress is not None:
+            progress(stop / length)
+    array.flush()
+    del array
+    os.replace(values_path + '.tmp', values_path)
+    save_sidecar(index_path, [variable.hdf.path, values_path], numbers=numbers)
+    return True
+
+
+def store_variables(model):
+    variables = {}
+    for variable in model.hdf.spatial_variables:
+        if isinstance(variable, (LandVariable, OverlandFlow, SurfaceDepth)):
+            variables.setdefault(source_name(variable), variable)
+    return list(variables.values())
+
+
+def convert(model, progress=None, cancelled=None):
+    variables = store_variables(model)
+    for i, variable in enumerate(variables):
+        if not convert_variable(variable,
+                                (lambda p, i=i: progress(100 * (i + p) / len(variables))) if progress else None,
+                                cancelled):
+            return False
+    return True
+
+
+class ElementStore:
+    def __init__(self, model):
+        self.model = model
+        self.arrays = {}
+
+    def open(self, variable):
+        name = source_name(variable)
+        values_path, index_path = paths(self.model, name)
+        stamp = source_stamp(variable.hdf.path) if os.path.exists(values_path) else None
+        if name in self.arrays and np.array_equal(self.arrays[name][0], stamp):
+            return self.arrays[name]
+        # Series workers read the stores too, so each entry is replaced whole rather than filled in place
+        entry = (stamp, None, None)
+        if stamp is not None:
+            index = load_sidecar(index_path, variable.hdf.path, values_path)
+            if index is not None:
+                entry = (stamp, index['numbers'], np.load(values_path, mmap_mode='r'))
+        self.arrays[name] = entry
+        return entry
+
+    def get_element(self, variable, element_number):
+        if not isinstance(variable, (LandVariable, OverlandFlow, SurfaceDepth)):
+            return variable.get_element(element_number)
+        _, numbers, values = self.open(variable)
+        if values is None:
+            return variable.get_element(element_number)
+        row = np.searchsorted(numbers, element_number)
+        if row == len(numbers) or numbers[row] != element_number:
+            raise ValueError('{} is not an element of {}'.format(element_number, variable.name))
+        return pd.Series(np.array(values[row]), index=variable.times)
+
+
+class ElementStores:
+    def __init__(self):
+        self.stores = {}
+        self.lock = Lock()
+
+    def get_element(self, variable, element_number):
+        model = variable.hdf.model
+        with self.lock:
+            if model not in self.stores:
+                self.stores[model] = ElementStore(model)
+            store = self.stores[model]
+        return store.get_element(variable, element_number)
+
+    def discard_model(self, model):
+        with self.lock:
+            self.stores.pop(model, None)
+
+
+class StoreWorker(QThread):
+    progress = pyqtSignal(float)
+
+    def __init__(self, model, parent=None):
+        QThread.__init__(self, parent)
+        self.model = model
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def run(self):
+        convert(self.model, self.progress.emit, lambda: self.cancelled)
+
+
+if __name__ == '__main__':
+    from shetranio.model import Model
+
+    parser = argparse.ArgumentParser(description='Write element-major copies of SHETran results for fast plotting')
+    parser.add_argument('library', nargs='+', help='library file of each model to convert')
+    arguments = parser.parse_args()
+
+    for library in arguments.library:
+        print('Converting {}'.format(library))
+        convert(Model(library), progress=lambda p: print('\r{:.0f}%'.format(p), end='', flush=True))
+        print()
@@ -0,0 +1,286 @@
+import math
+import os
+import sqlite3
+import time as clock
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock
+from urllib.error import HTTPError, URLError
+from urllib.request import Request, urlopen
+from PyQt5.QtCore import QThread, pyqtSignal
+from settings import tile_url, tile_bulk_download, tile_cache_size, tile_prefetch_limit, tile_policy_zoom, \
+    tile_policy_limit, tile_retry_interval
+
+user_agent = 'ShetranResultsViewer'
+
+
+def tile_xy(lat, lng, zoom):
+    n = 2 ** zoom
+    lat = max(min(lat, 85.0511), -85.0511)
+    x = int((lng + 180) / 360 * n)
+    y = int((1 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2 * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+def tiles_for_bounds(bounds, zooms, limit=tile_prefetch_limit,
+                     policy_limit=None if tile_bulk_download else tile_policy_limit):
+    (south, west), (north, east) = bounds
+    tiles = []
+    policy_tiles = 0
+    for zoom in zooms:
+        x0, y0 = tile_xy(north, west, zoom)
+        x1, y1 = tile_xy(south, east, zoom)
+        count = (x1 - x0 + 1) * (y1 - y0 + 1)
+        if len(tiles) + count > limit:
+            break
+        if policy_limit is not None and zoom >= tile_policy_zoom:
+            if policy_tiles + count > policy_limit:
+                break
+            policy_tiles += count
+        tiles += [(zoom, x, y) for x in range(x0, x1 + 1) for y in range(y0, y1 + 1)]
+    return tiles
+
+
+class MBTiles:
+    def __init__(self, path, max_size=tile_cache_size * 1024 ** 2):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.max_size = max_size
+        self.lock = Lock()
+        self.used = {}
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.connection as c:
+            c.execute('CREATE TABLE IF NOT EXISTS metadata (name TEXT, value TEXT)')
+            c.execute('CREATE TABLE IF NOT EXISTS tiles '
+                      '(zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_data BLOB)')
+            c.execute('CREATE UNIQUE INDEX IF NOT EXISTS tile_index ON tiles (zoom_level, tile_column, tile_row)')
+            c.execute('CREATE TABLE IF NOT EXISTS tile_usage (zoom_level INTEGER, tile_column INTEGER, '
+                      'tile_row INTEGER, used REAL, PRIMARY KEY (zoom_level, tile_column, tile_row))')
+            if c.execute('SELECT COUNT(*) FROM metadata').fetchone()[0] == 0:
+                c.executemany('INSERT INTO metadata VALUES (?, ?)',
+                              [('name', 'SHETran Results Viewer basemap'), ('format', 'png')])
+        # Measured on the first write, as reading tiles does not need it
+        self.size = None
+
+    @staticmethod
+    def key(z, x, y):
+        # MBTiles rows count from the south
+        return z, x, 2 ** z - 1 - y
+
+    def get(self, z, x, y):
+        key = self.key(z, x, y)
+        with self.lock:
+            row = self.connection.execute('SELECT tile_data FROM tiles WHERE zoom_level = ? AND tile_column = ? '
+                                          'AND tile_row = ?', key).fetchone()
+            if row is None:
+                return None
+            self.used[key] = clock.time()
+            return bytes(row[0])
+
+    def put(self, z, x, y, data):
+        key = self.key(z, x, y)
+        with self.lock, self.connection as c:
+            self.flush()
+            if self.size is None:
+                self.size = c.execute('SELECT COALESCE(SUM(LENGTH(tile_data)), 0) FROM tiles').fetchone()[0]
+            row = c.execute('SELECT LENGTH(tile_data) FROM tiles WHERE zoom_level = ? AND tile_column = ? '
+                            'AND tile_row = ?', key).fetchone()
+            c.execute('INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?)', key + (sqlite3.Binary(data),))
+            c.execute('INSERT OR REPLACE INTO tile_usage VALUES (?, ?, ?, ?)', key + (clock.time(),))
+            self.size += len(data) - (row[0] if row else 0)
+            if self.size > self.max_size:
+                self.evict(c)
+
+    def flush(self):
+        if self.used:
+            self.connection.executemany('INSERT OR REPLACE INTO tile_usage VALUES (?, ?, ?, ?)',
+                                        [key + (used,) for key, used in self.used.items()])
+            self.used = {}
+
+    def evict(self, c):
+        rows = c.execute('SELECT zoom_level, tile_column, tile_row, LENGTH(tile_data) FROM tiles '
+                         'LEFT JOIN tile_usage USING (zoom_level, tile_column, tile_row) '
+                         'ORDER BY COALESCE(used, 0)').fetchall()
+        evicted = []
+        for z, x, row, size in rows:
+            if self.size <= 0.9 * self.max_size:
+                break
+            evicted.append((z, x, row))
+            self.size -= size
+        for table in ['tiles', 'tile_usage']:
+            c.executemany('DELETE FROM {} WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?'.format(table),
+                          evicted)
+
+    def close(self):
+        with self.lock, self.connection:
+            self.flush()
+        self.connection.close()
+
+
+class TileDirectory:
+    def __init__(self, path, max_size=tile_cache_size * 1024 ** 2):
+        self.path = path
+        self.max_size = max_size
+        self.lock = Lock()
+        os.makedirs(path, exist_ok=True)
+        self.size = None
+
+    def tile_path(self, z, x, y):
+        return os.path.join(self.path, str(z), str(x), '{}.png'.format(y))
+
+    def get(self, z, x, y):
+        path = self.tile_path(z, x, y)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            # The modification time records when a tile was last used, for eviction
+            os.utime(path)
+            return data
+        except OSError:
+            return None
+
+    def put(self, z, x, y, data):
+        path = self.tile_path(z, x, y)
+        with self.lock:
+            if self.size is None:
+                self.size = sum(os.path.getsize(os.path.join(root, name))
+                                for root, _, names in os.walk(self.path) for name in names)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            previous = os.path.getsize(path) if os.path.exists(path) else 0
+            with open(path, 'wb') as f:
+                f.write(data)
+            self.size += len(data) - previous
+            if self.size > self.max_size:
+                self.evict()
+
+    def evict(self):
+        paths = [os.path.join(root, name) for root, _, names in os.walk(self.path) for name in names]
+        for path in sorted(paths, key=os.path.getmtime):
+            if self.size <= 0.9 * self.max_size:
+                break
+            self.size -= os.path.getsize(path)
+            os.remove(path)
+
+    def close(self):
+        pass
+
+
+def open_tiles(path):
+    if path.endswith('.mbtiles'):
+        return MBTiles(path)
+    return TileDirectory(path)
+
+
+class TileSource:
+    def __init__(self, path, url=tile_url, offline=False):
+        self.path = path
+        self.url = url
+        self.offline = offline
+        self.retry_time = 0
+        self.store = None
+        self.lock = Lock()
+
+    def open(self):
+        # The store is opened by the first tile request, on a tile server thread rather than the GUI thread
+        with self.lock:
+            if self.store is None:
+                self.store = open_tiles(self.path)
+            return self.store
+
+    @property
+    def online(self):
+        return not self.offline and clock.time() >= self.retry_time
+
+    def get(self, z, x, y):
+        data = self.open().get(z, x, y)
+        if data is None and self.online:
+            data = self.fetch(z, x, y)
+        return data
+
+    def fetch(self, z, x, y):
+        url = self.url.format(s='abc'[(x + y) % 3], z=z, x=x, y=y)
+        try:
+            with urlopen(Request(url, headers={'User-Agent': user_agent}), timeout=10) as response:
+                data = response.read()
+        except HTTPError:
+            return None
+        except (URLError, OSError):
+            # Stop asking for a while so an air-gapped machine only waits on the first tile
+            self.retry_time = clock.time() + tile_retry_interval
+            return None
+        self.open().put(z, x, y, data)
+        return data
+
+    def close(self):
+        with self.lock:
+            if self.store is not None:
+                self.store.close()
+
+
+class TileHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        try:
+            z, x, y = [int(part) for part in self.path.split('?')[0].strip('/').rsplit('.', 1)[0].split('/')]
+        except ValueError:
+            self.send_error(404)
+            return
+        data = self.server.tiles.get(z, x, y)
+        if data is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/png')
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('Cache-Control', 'max-age=86400')
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class TileServer(QThread):
+    def __init__(self, tiles, parent=None):
+        QThread.__init__(self, parent)
+        self.tiles = tiles
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), TileHandler)
+        self.server.daemon_threads = True
+        self.server.tiles = tiles
+        self.url = 'http://127.0.0.1:{}/{{z}}/{{x}}/{{y}}.png'.format(self.server.server_address[1])
+
+    def run(self):
+        self.server.serve_forever()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.wait()
+        self.tiles.close()
+
+
+class TilePrefetcher(QThread):
+    progress = pyqtSignal(float)
+
+    def __init__(self, tiles, bounds, zooms, parent=None):
+        QThread.__init__(self, parent)
+        self.tiles = tiles
+        self.bounds = bounds
+        self.zooms = zooms
+        self.cancelled = False
+        self.fetched = 0
+        self.missing = 0
+        self.max_zoom = None
+
+    def cancel(self):
+        self.cancelled = True
+
+    def run(self):
+        tiles = tiles_for_bounds(self.bounds, self.zooms)
+        self.max_zoom = tiles[-1][0] if tiles else None
+        for i, (z, x, y) in enumerate(tiles):
+            if self.cancelled or not self.tiles.online:
+                self.missing += len(tiles) - i
+                return
+            if self.tiles.get(z, x, y) is None:
+                self.missing += 1
+            else:
+                self.fetched += 1
+            self.progress.emit(100 * (i + 1) / len(tiles))
@@ -0,0 +1,112 @@
+import functools
+import json
+import os
+import platform
+import sys
+import threading
+import time as clock
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime
+from PyQt5.QtCore import QThread, QCoreApplication
+from settings import trace_buffer_size
+
+
+class Tracer:
+    def __init__(self):
+        self.enabled = False
+        self.path = None
+        self.events = deque(maxlen=trace_buffer_size)
+        self.threads = {}
+        self.last = {}
+        self.origin = clock.perf_counter()
+
+    def enable(self, path=None):
+        self.enabled = True
+        self.path = path
+
+    def thread_name(self):
+        ident = threading.get_ident()
+        if ident not in self.threads:
+            thread = QThread.currentThread()
+            app = QCoreApplication.instance()
+            if app is not None and thread is app.thread():
+                self.threads[ident] = 'Main'
+            else:
+                self.threads[ident] = thread.objectName() or type(thread).__name__
+        return ident
+
+    def record(self, name, start, stop, args=None):
+        self.last[name] = stop - start
+        if self.path is None:
+            return
+        event = {'name': name, 'ph': 'X', 'pid': os.getpid(), 'tid': self.thread_name(),
+                 'ts': (start - self.origin) * 1e6, 'dur': (stop - start) * 1e6}
+        if args:
+            event['args'] = args
+        self.events.append(event)
+
+    def save(self, path=None):
+        path = path or self.path
+        if path is None:
+            return
+        metadata = [{'name': 'process_name', 'ph': 'M', 'pid': os.getpid(), 'args': {'name': 'SHETran Results Viewer'}}]
+        metadata += [{'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': ident, 'args': {'name': name}}
+                     for ident, name in list(self.threads.items())]
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': metadata + list(self.events), 'displayTimeUnit': 'ms'}, f)
+
+
+tracer = Tracer()
+
+
+class StartupTimer:
+    def __init__(self, origin=None):
+        self.origin = clock.perf_counter() if origin is None else origin
+        self.marks = {}
+        self.saved = False
+
+    def mark(self, name):
+        if name in self.marks:
+            return
+        now = clock.perf_counter()
+        self.marks[name] = now - self.origin
+        if tracer.enabled:
+            tracer.record('Startup: {}'.format(name), self.origin, now)
+
+    def report(self):
+        return '\n'.join('{:<20} {:7.3f} s'.format(name, seconds) for name, seconds in self.marks.items())
+
+    def save(self, path):
+        if self.saved:
+            return
+        self.saved = True
+        if sys.stdout is not None:
+            print(self.report())
+        record = {'date': datetime.now().isoformat(timespec='seconds'), 'frozen': bool(getattr(sys, 'frozen', False)),
+                  'python': platform.python_version(), 'platform': sys.platform,
+                  'marks': {name: round(seconds, 3) for name, seconds in self.marks.items()}}
+        with open(path, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+
+@contextmanager
+def span(name, **args):
+    if not tracer.enabled:
+        yield
+        return
+    start = clock.perf_counter()
+    try:
+        yield
+    finally:
+        tracer.record(name, start, clock.perf_counter(), args)
+
+
+def traced(function):
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if not tracer.enabled:
+            return function(*args, **kwargs)
+        with span(function.__qualname__):
+            return function(*args, **kwargs)
+    return wrapper
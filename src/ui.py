@@ -1,25 +1,78 @@
+import time as clock
+started = clock.perf_counter()
 import sys
-from shetranio.model import Model
-from shetranio.hdf import LandVariable
 import argparse
+import importlib
 import os
 from PyQt5.QtWidgets import QSplitter, QRadioButton, QHBoxLayout, QComboBox, QProgressBar, QCheckBox, QMessageBox, \
-    QApplication, QMainWindow, QSizePolicy, QPushButton, QFileDialog, QVBoxLayout, QWidget, QSlider, QInputDialog
-from PyQt5.QtCore import QThread, Qt
-import pandas as pd
-from plot import PlotCanvas
-from legend import LegendCanvas
-from map import MapCanvas
+    QApplication, QMainWindow, QSizePolicy, QPushButton, QFileDialog, QVBoxLayout, QWidget, QSlider, QInputDialog, \
+    QSpinBox, QDoubleSpinBox, QLabel
+from PyQt5.QtCore import Qt, QTimer, QObject, QThread, QCoreApplication
+from tracing import tracer, traced, StartupTimer
+from tiles import TileSource, TileServer, TilePrefetcher
+from settings import frame_cache_size, prefetch_frames, element_cache_size, hover_latency, model_loaders, \
+    tile_cache_path, tile_prefetch_zooms
+
+# The window is shown before these are imported, in the background while the user picks a library file
+preload_modules = ['numpy', 'pandas', 'h5py', 'matplotlib.colors', 'shetranio.model', 'models', 'frames', 'stats',
+                   'pyramid', 'store', 'discharge', 'observed', 'metrics', 'ensemble']
+
+period_modes = {'Period Mean': 'mean', 'Period Minimum': 'min', 'Period Maximum': 'max'}
+
+startup = StartupTimer(started)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-l')
+    parser.add_argument('--trace', metavar='PATH',
+                        help='write a Chrome/Perfetto trace of the hot paths to PATH on exit')
+    parser.add_argument('--frame-times', action='store_true', help='show render and draw times in the status bar')
+    parser.add_argument('--startup-report', metavar='PATH', help='append the startup timings to PATH as JSON')
+    parser.add_argument('--cache-size', type=int, default=frame_cache_size, help='frame cache size in MB')
+    parser.add_argument('--tiles', metavar='PATH', help='MBTiles file or directory to cache basemap tiles in')
+    parser.add_argument('--offline', action='store_true', help='only show basemap tiles that are already cached')
+    return parser.parse_args(argv)
+
+
+class Preloader(QThread):
+    def __init__(self, modules, parent=None):
+        QThread.__init__(self, parent)
+        self.modules = modules
+
+    def run(self):
+        for module in self.modules:
+            try:
+                importlib.import_module(module)
+            except ImportError:
+                # Reported properly when the module is first used
+                pass
+
+
+class RenderScheduler(QObject):
+    def __init__(self, render, parent=None, delay=0):
+        super().__init__(parent)
+        self.render = render
+        self.delay = delay
+        self.pending = False
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.timeout.connect(self.flush)
 
+    def request(self):
+        self.pending = True
+        if not self.timer.isActive():
+            self.timer.start(self.delay)
 
-parser = argparse.ArgumentParser()
-parser.add_argument('-l')
-args = parser.parse_args()
+    def flush(self):
+        if self.pending:
+            self.pending = False
+            self.render()
 
 
 class App(QMainWindow):
 
-    def __init__(self):
+    def __init__(self, args):
         super().__init__()
 
         self.models = []
@@ -28,12 +81,63 @@ class App(QMainWindow):
         self.variable = None
 
         self.disable_clicking = False
+        self.scheduler = RenderScheduler(self.render, parent=self)
+
+        if self.args.trace or self.args.frame_times:
+            tracer.enable(self.args.trace)
+        self.frame_times = None
+        self.frame_clock = None
+        self.frame_rate = 0
+
+        self.frames = None
+        self.prefetcher = None
+        self.element_stores = None
+        self.element_cache = None
+        self.series_worker = None
+        self.discharge = None
+        self.preloader = Preloader(preload_modules, parent=self)
+        self.preloader.finished.connect(lambda: startup.mark('Modules preloaded'))
+        self.hover_element = None
+        self.hover_scheduler = RenderScheduler(self.request_series, parent=self, delay=hover_latency)
+        self.store_worker = None
+        self.stats = {}
+        self.stats_workers = {}
+        self.pyramids = {}
+        self.pyramid_workers = {}
+        self.tiles = TileSource(self.args.tiles or tile_cache_path or os.path.join(
+            os.path.expanduser('~'), '.shetran-results-viewer', 'tiles.mbtiles'), offline=self.args.offline)
+        self.tile_server = TileServer(self.tiles, parent=self)
+        self.tile_server.start()
+        self.tile_prefetcher = None
 
         self.modelDropDown = QComboBox()
         self.modelDropDown.activated.connect(self.set_model)
 
         self.slider = QSlider(parent=self, orientation=Qt.Horizontal, )
         self.slider.valueChanged.connect(self.set_time)
+        self.slider.sliderPressed.connect(self.pause)
+
+        self.play_button = QPushButton(text='Play')
+        self.play_button.clicked.connect(self.toggle_playback)
+
+        self.speedSpinBox = QDoubleSpinBox()
+        self.speedSpinBox.setRange(0.1, 1000)
+        self.speedSpinBox.setValue(10)
+        self.speedSpinBox.valueChanged.connect(self.restart_playback)
+
+        self.speedUnitDropDown = QComboBox()
+        self.speedUnitDropDown.addItems(['frames/s', 'days/s'])
+        self.speedUnitDropDown.activated.connect(self.restart_playback)
+
+        self.stepSpinBox = QSpinBox()
+        self.stepSpinBox.setPrefix('Step: ')
+        self.stepSpinBox.setRange(1, 10000)
+        self.stepSpinBox.valueChanged.connect(self.restart_playback)
+
+        self.playback_timer = QTimer(self)
+        self.playback_timer.setTimerType(Qt.PreciseTimer)
+        self.playback_timer.timeout.connect(self.play_frame)
+        self.playback_start = None
 
         self.droppedPath = None
 
@@ -47,9 +151,12 @@ class App(QMainWindow):
         self.differenceDropDown.activated.connect(self.set_model)
 
         self.series = None
-
-        self.add_model()
-        self.model = self.models[0]
+        self.gauges = []
+        self.observed = None
+        self.observed_stores = {}
+        self.model = None
+        self.loaders = []
+        self.queued_loaders = []
 
         row1 = QHBoxLayout()
         row2 = QHBoxLayout()
@@ -75,8 +182,6 @@ class App(QMainWindow):
         self.plot_on_hover.setGeometry(600, 10, 100, 50)
 
         self.variableDropDown = QComboBox()
-        for variable in self.model.hdf.spatial_variables:
-            self.variableDropDown.addItem(variable.long_name)
         self.variableDropDown.activated.connect(self.set_variables)
 
         self.download_button = QPushButton(text='Download')
@@ -94,6 +199,9 @@ class App(QMainWindow):
         self.clear_series_button = QPushButton(text='Clear Series')
         self.clear_series_button.clicked.connect(self.clear_series)
 
+        self.convert_button = QPushButton(text='Build Element Store')
+        self.convert_button.clicked.connect(self.convert_model)
+
         row2.addWidget(self.variableDropDown)
         row2.addWidget(self.differenceCheckBox)
         row2.addWidget(self.differenceDropDown)
@@ -102,6 +210,7 @@ class App(QMainWindow):
         row2.addWidget(self.add_series_button)
         row2.addWidget(self.clear_series_button)
         row2.addWidget(self.download_button)
+        row2.addWidget(self.convert_button)
         row2.addWidget(self.plot_on_click)
         row2.addWidget(self.plot_on_hover)
 
@@ -111,46 +220,54 @@ class App(QMainWindow):
         self.time = 0
 
         self.progress = QProgressBar(self)
+        self.progress.hide()
 
-        self.resampleCheckBox = QCheckBox('Plot Monthly Means')
-        self.resampleCheckBox.stateChanged.connect(self.update_resample)
+        self.cancel_button = QPushButton(text='Cancel')
+        self.cancel_button.clicked.connect(self.cancel_loading)
+        self.cancel_button.hide()
+
+        self.resolutionDropDown = QComboBox()
+        self.resolutionDropDown.activated.connect(self.update_resample)
 
         self.outletCheckBox = QCheckBox('Outlet Discharge')
         self.outletCheckBox.stateChanged.connect(self.update_outlet)
-        try:
-            assert self.model.get('SimulatedDischargeTimestep') is not None
-            assert os.path.exists(self.model.path('output_{}_discharge_sim_regulartimestep.txt'.format(
-                self.model.catchment_name)))
-        except AssertionError:
-            self.outletCheckBox.setDisabled(True)
+
+        self.fixedScaleCheckBox = QCheckBox('Fixed Scale')
+        self.fixedScaleCheckBox.stateChanged.connect(lambda: self.set_time(self.time))
+
+        self.mapModeDropDown = QComboBox()
+        self.mapModeDropDown.activated.connect(self.set_map_mode)
 
         row2.addWidget(self.progress)
-        row3.addWidget(self.resampleCheckBox)
+        row2.addWidget(self.cancel_button)
+        row3.addWidget(self.resolutionDropDown)
         row3.addWidget(self.outletCheckBox)
+        row3.addWidget(self.fixedScaleCheckBox)
+        row3.addWidget(self.mapModeDropDown)
+        row3.addWidget(self.play_button)
+        row3.addWidget(self.speedSpinBox)
+        row3.addWidget(self.speedUnitDropDown)
+        row3.addWidget(self.stepSpinBox)
         row3.addWidget(self.slider)
 
         self.setWindowTitle(self.title)
 
-        plot_layout = QVBoxLayout()
-        self.plotCanvas = PlotCanvas(self)
+        # The plot, map and legend are created by init_views when the first model is added
+        self.plot_layout = QVBoxLayout()
+        self.plotCanvas = None
         self.plotZoom = QSlider(orientation=Qt.Horizontal)
-        self.plotZoom.valueChanged.connect(self.plotCanvas.set_zoom)
-        plot_layout.addWidget(self.plotCanvas)
-        plot_layout.addWidget(self.plotZoom)
+        self.plot_layout.addWidget(self.plotZoom)
 
         plot = QWidget()
-        plot.setLayout(plot_layout)
+        plot.setLayout(self.plot_layout)
         row4.addWidget(plot)
 
-        map_and_legend_layout = QVBoxLayout()
-
-        self.mapCanvas = MapCanvas(self)
-        self.legendCanvas = LegendCanvas(self)
-        map_and_legend_layout.addWidget(self.mapCanvas)
-        map_and_legend_layout.addWidget(self.legendCanvas)
+        self.map_and_legend_layout = QVBoxLayout()
+        self.mapCanvas = None
+        self.legendCanvas = None
 
         map_and_legend = QWidget()
-        map_and_legend.setLayout(map_and_legend_layout)
+        map_and_legend.setLayout(self.map_and_legend_layout)
 
         width = 500
         height = 400
@@ -165,19 +282,16 @@ class App(QMainWindow):
         row4.setCollapsible(0, False)
         row4.setCollapsible(1, False)
 
-        self.mapCanvas.progress.connect(self.set_progress)
-        self.mapCanvas.clickedElement.connect(self.update_element)
-        self.mapCanvas.loaded.connect(self.on_load)
-
-        self.mapCanvas.add_data(self.model)
-
         self.rename = QPushButton(parent=self, text='Rename Model')
         row1.addWidget(self.rename)
         self.rename.clicked.connect(self.rename_model)
 
         self.pan = QPushButton(parent=self, text='Reset View')
         row1.addWidget(self.pan)
-        self.pan.clicked.connect(self.mapCanvas.pan_to)
+
+        self.cache_tiles_button = QPushButton(parent=self, text='Cache Basemap')
+        row1.addWidget(self.cache_tiles_button)
+        self.cache_tiles_button.clicked.connect(self.cache_tiles)
 
         rows = QVBoxLayout()
         for row in [row1, row2, row3]:
@@ -189,13 +303,67 @@ class App(QMainWindow):
         rows.addWidget(row4)
         self.setAcceptDrops(True)
 
-        self.model.hdf.get_elevations()
+        self.model_controls = [self.modelDropDown, self.rename, self.pan, self.cache_tiles_button,
+                               self.variableDropDown, self.differenceCheckBox, self.remove_model_button,
+                               self.add_series_button, self.clear_series_button, self.download_button,
+                               self.convert_button, self.plot_on_click, self.plot_on_hover, self.resolutionDropDown,
+                               self.outletCheckBox, self.fixedScaleCheckBox, self.mapModeDropDown, self.play_button,
+                               self.speedSpinBox, self.speedUnitDropDown, self.stepSpinBox, self.slider,
+                               self.plotZoom]
+        for control in self.model_controls:
+            control.setEnabled(False)
 
         self.mainWidget.setLayout(rows)
         self.setCentralWidget(self.mainWidget)
-        self.set_variables(0)
+        if self.args.frame_times:
+            self.frame_times = QLabel()
+            self.statusBar().addPermanentWidget(self.frame_times)
         self.show()
         self.activateWindow()
+        QTimer.singleShot(0, self.start)
+
+    def start(self):
+        startup.mark('Window shown')
+        self.preloader.start()
+        self.add_model()
+
+    def init_views(self):
+        from frames import FrameCache, Prefetcher
+        from store import ElementStores
+        from cache import ElementCache
+        from discharge import DischargeCache
+        from ensemble import modes as ensemble_modes
+        from pyramid import levels as pyramid_levels
+        from plot import PlotCanvas, SeriesWorker
+        from legend import LegendCanvas
+        from map import MapCanvas
+
+        self.frames = FrameCache(self.args.cache_size * 1024 ** 2)
+        self.prefetcher = Prefetcher(self.frames, prefetch_frames, parent=self)
+        self.prefetcher.start()
+        self.element_stores = ElementStores()
+        self.element_cache = ElementCache(element_cache_size * 1024 ** 2, self.element_stores.get_element)
+        self.series_worker = SeriesWorker(self.element_cache, parent=self)
+        self.series_worker.loaded.connect(self.on_series)
+        self.series_worker.start()
+        self.discharge = DischargeCache()
+
+        self.resolutionDropDown.addItems(['All Timesteps'] + [level for level, _ in pyramid_levels])
+        self.mapModeDropDown.addItems(['Timestep', 'Mean', 'Maximum'] + list(period_modes) + ensemble_modes)
+
+        self.plotCanvas = PlotCanvas(self)
+        self.plotZoom.valueChanged.connect(self.plotCanvas.set_zoom)
+        self.plot_layout.insertWidget(0, self.plotCanvas)
+        self.plot_layout.addWidget(self.plotCanvas.metrics_table)
+
+        self.mapCanvas = MapCanvas(self)
+        self.legendCanvas = LegendCanvas(self)
+        self.map_and_legend_layout.addWidget(self.mapCanvas)
+        self.map_and_legend_layout.addWidget(self.legendCanvas)
+        self.mapCanvas.clickedElement.connect(self.update_element)
+        self.mapCanvas.loaded.connect(self.on_load)
+        self.pan.clicked.connect(self.mapCanvas.pan_to)
+        startup.mark('Views created')
 
     def dragEnterEvent(self, event):
         if event.mimeData().hasText():
@@ -217,7 +385,10 @@ class App(QMainWindow):
             self.add_model()
 
     def add_model(self):
+        from models import ModelLoader
+
         if self.args.l is None and self.droppedPath is None:
+            startup.mark('File dialog shown')
             library_path = QFileDialog.getOpenFileName(
                 self,
                 'Choose a library file',
@@ -235,30 +406,93 @@ class App(QMainWindow):
             text, ok = QInputDialog.getText(self, "Model Name", "Enter a model name", text=str(len(self.models)+1))
 
             if ok and text:
+                if self.mapCanvas is None:
+                    self.init_views()
+                loader = ModelLoader(library_path, text, geometry=self.mapCanvas.table is None, parent=self)
+                loader.progress.connect(self.set_loading_progress)
+                loader.loaded.connect(self.on_model_loaded)
+                loader.failed.connect(self.on_model_failed)
+                loader.finished.connect(lambda loader=loader: self.finish_loading(loader))
+                self.loaders.append(loader)
+                self.queued_loaders.append(loader)
+                self.start_loaders()
+                self.update_progress()
+
+    def start_loaders(self):
+        while self.queued_loaders and len(self.loaders) - len(self.queued_loaders) < model_loaders:
+            self.queued_loaders.pop(0).start()
+
+    def set_loading_progress(self, loader, progress, stage):
+        loader.percent = progress
+        loaders = [loader for loader in self.loaders if not loader.cancelled and hasattr(loader, 'percent')]
+        if loaders:
+            self.progress.setFormat('{} %p%'.format(stage))
+            self.set_progress(sum(loader.percent for loader in loaders) / len(loaders))
+
+    def finish_loading(self, loader):
+        loader.wait()
+        self.loaders.remove(loader)
+        self.start_loaders()
+        if not self.loaders:
+            self.progress.setFormat('%p%')
+        self.update_progress()
+
+    def on_model_loaded(self, loader):
+        from cache import sidecar_path
+        from observed import ObservedStore
+
+        if loader.cancelled:
+            return
+        model = loader.model
+        self.models.append(model)
+        self.modelDropDown.addItem('{} - {}'.format(model.name, model.library))
+        self.differenceDropDown.addItem(model.name)
+
+        self.observed_stores[model] = ObservedStore(sidecar_path(model, 'observed.json'))
+
+        if self.model is None:
+            self.model = model
+            self.observed = self.observed_stores[model]
+            for variable in self.model.hdf.spatial_variables:
+                self.variableDropDown.addItem(variable.long_name)
+            for control in self.model_controls:
+                control.setEnabled(True)
+            self.check_outlet()
+            if self.mapCanvas.table is None:
+                self.mapCanvas.add_elements(loader.table, *loader.features)
+            self.set_variables(0)
+            startup.mark('First model shown')
+            if self.args.startup_report:
+                startup.save(self.args.startup_report)
+        else:
+            self.set_variables(self.variableDropDown.currentIndex())
 
-                try:
+        self.differenceCheckBox.setEnabled(len(self.models) > 1)
 
-                    model = Model(library_path, name=text)
-                    self.models.append(model)
-                    self.modelDropDown.addItem('{} - {}'.format(model.name, model.library))
-                    self.differenceDropDown.addItem(model.name)
-                    self.differenceCheckBox.setEnabled(len(self.models) > 1)
+    def on_model_failed(self, loader, message):
+        if loader.cancelled:
+            return
+        msg = QMessageBox()
+        msg.setText(message)
+        msg.exec_()
+        self.add_model()
 
-                    table_elev = LandVariable(model.hdf, 'ph_depth')
-                    table_elev.long_name = 'Water Table Elevation (m)'
-                    table_elev.name = 'table_elev'
-                    model.hdf.variables.append(table_elev)
-                    model.hdf.spatial_variables.append(table_elev)
+    def cancel_loading(self):
+        for loader in self.queued_loaders:
+            self.loaders.remove(loader)
+        self.queued_loaders = []
+        for loader in self.loaders:
+            loader.cancel()
+        self.update_progress()
 
-                    if len(self.models) > 1:
-                        self.set_variables(self.variableDropDown.currentIndex())
+    def check_outlet(self):
+        from discharge import discharge_path
 
-                except:
-                    import traceback
-                    msg = QMessageBox()
-                    msg.setText(traceback.format_exc())
-                    msg.exec_()
-                    self.add_model()
+        try:
+            assert self.model.get('SimulatedDischargeTimestep') is not None
+            assert os.path.exists(discharge_path(self.model))
+        except AssertionError:
+            self.outletCheckBox.setDisabled(True)
 
 
     def rename_model(self):
@@ -269,7 +503,7 @@ class App(QMainWindow):
             idx = self.modelDropDown.currentIndex()
             self.modelDropDown.setItemText(idx, '{} - {}'.format(self.model.name, self.model.library))
             self.differenceDropDown.setItemText(idx, self.model.name)
-            self.plotCanvas.update_data()
+            self.update_plot()
 
 
     def remove_model(self):
@@ -279,17 +513,20 @@ class App(QMainWindow):
         self.differenceDropDown.removeItem(self.models.index(self.model))
         self.modelDropDown.setCurrentIndex(0)
         self.models.remove(self.model)
+        self.observed_stores.pop(self.model)
+        self.frames.discard_model(self.model)
+        self.element_cache.discard_model(self.model)
+        self.element_stores.discard_model(self.model)
+        self.discharge.discard_model(self.model)
+        self.discard_stats(self.model)
         self.differenceCheckBox.setEnabled(len(self.models) > 1)
         self.set_model()
         self.set_variables(self.variableDropDown.currentIndex())
 
     def show_or_hide_difference_dropdown(self):
         self.differenceDropDown.setEnabled(self.differenceCheckBox.isChecked())
-        self.mapCanvas.set_time(self.time, self.variable,
-                                self.variables[self.differenceDropDown.currentIndex()]
-                                if self.differenceCheckBox.isChecked() else None)
-        self.series = None
-        self.plotCanvas.update_data()
+        self.set_time(self.time)
+        self.update_plot()
 
     def add_series(self):
         if self.droppedPath is None:
@@ -307,17 +544,11 @@ class App(QMainWindow):
         if os.path.exists(series_path):
 
             try:
-                self.series = pd.read_csv(series_path, usecols=[0, 1], index_col=0, squeeze=True)
-                self.series.index = pd.DatetimeIndex(pd.to_datetime(self.series.index, dayfirst=True))
-
-                start = max(min(self.variables[0].times), min(self.series.index))
-                end = min(max(self.variables[0].times), max(self.series.index))
-                self.series = self.series.sort_index().loc[start:end].rename('observed')
+                self.observed.add(self.gauge_key(), series_path)
                 self.differenceCheckBox.setChecked(False)
                 self.differenceDropDown.setEnabled(False)
-                self.plotCanvas.update_data()
+                self.update_plot()
             except:
-                self.series = None
                 print('Could not read series')
                 import traceback
                 msg = QMessageBox()
@@ -327,23 +558,56 @@ class App(QMainWindow):
 
 
     def clear_series(self):
-        self.series = None
+        self.observed.remove(self.gauge_key())
+        self.update_plot()
+
+    def gauge_key(self):
+        return 'outlet' if self.outletCheckBox.isChecked() else self.element.number
+
+    def select_gauges(self):
+        if self.observed is None or self.differenceCheckBox.isChecked():
+            self.gauges = []
+        else:
+            times = self.variables[0].times
+            self.gauges = self.observed.get(self.gauge_key(), times[0], times[-1])
+        self.series = self.gauges[0] if self.gauges else None
+
+    def update_plot(self):
+        self.select_gauges()
         self.plotCanvas.update_data()
 
     def set_variables(self, variable_index):
         self.variables = [model.hdf.spatial_variables[variable_index] for model in self.models]
         self.variable = self.variables[self.models.index(self.model)]
         self.slider.setMaximum(len(self.variables[0].times) - 1)
+        self.update_map_modes()
         self.switch_elements()
         self.set_time(self.time)
 
+    def update_map_modes(self):
+        from ensemble import mismatch, modes as ensemble_modes
+
+        # Ensemble maps combine every model element by element and timestep by timestep
+        reason = mismatch(self.variables)
+        items = self.mapModeDropDown.model()
+        for i in range(self.mapModeDropDown.count()):
+            if self.mapModeDropDown.itemText(i) in ensemble_modes:
+                items.item(i).setEnabled(reason is None)
+                items.item(i).setToolTip(reason or '')
+        if reason is not None and self.mapModeDropDown.currentText() in ensemble_modes:
+            self.mapModeDropDown.setCurrentIndex(0)
+            msg = QMessageBox()
+            msg.setText('Ensemble maps are not available. {}'.format(reason))
+            msg.exec_()
+
     def update_resample(self):
-        self.plotCanvas.update_data()
+        self.set_time(self.time)
+        self.update_plot()
 
     def update_outlet(self):
         if self.outletCheckBox.isChecked():
             self.download_button.setEnabled(False)
-            self.plotCanvas.update_data()
+            self.update_plot()
             self.disable_clicking = True
 
         else:
@@ -352,55 +616,63 @@ class App(QMainWindow):
 
         self.switch_elements()
 
+    @traced
     def update_element(self, element):
-        if not self.disable_clicking:
+        if self.plot_on_hover.isChecked():
+            self.hover_element = element
+            self.hover_scheduler.request()
+        elif not self.disable_clicking:
             try:
-                self.variables[0].get_element(element.number)
+                self.element_cache.get(self.variables[0], element.number)
             except ValueError:
                 return
             self.element = element
-            self.plotCanvas.update_data()
-
-    def set_hover(self):
-        class Thread(QThread):
-            def __init__(self, parent=None):
-                QThread.__init__(self)
-                self.setParent(parent)
+            self.update_plot()
 
-            def __del__(self):
-                self.wait()
+    def request_series(self):
+        self.series_worker.request(self.hover_element, self.variables)
 
-            def run(self):
-                if self.parent().plot_on_click.isChecked():
-                    self.parent().mapCanvas.set_onclick()
-                else:
-                    self.parent().mapCanvas.set_onhover()
+    @traced
+    def on_series(self, element, values):
+        if element is not self.hover_element or self.disable_clicking:
+            return
+        self.element = element
+        self.select_gauges()
+        self.plotCanvas.update_element(values)
 
-        Thread(self).start()
+    def set_hover(self):
+        self.mapCanvas.set_hover(self.plot_on_hover.isChecked())
 
+    @traced
     def switch_elements(self):
         if self.variables[0].is_river:
             self.mapCanvas.show_rivers()
-            self.element = self.mapCanvas.river_elements[0]
         else:
             self.mapCanvas.show_land()
-            self.element = self.mapCanvas.land_elements[0]
+        self.element = self.mapCanvas.table.element_at(self.mapCanvas.visible_rows[0])
 
-        self.plotCanvas.update_data()
+        self.update_plot()
 
     def on_load(self):
-        self.progress.hide()
         self.plotCanvas.show()
         self.mapCanvas.show()
 
     def set_progress(self, progress):
-        self.progress.setValue(progress)
+        self.progress.setValue(int(progress))
+
+    def update_progress(self):
+        loading = any(not loader.cancelled for loader in self.loaders)
+        self.progress.setVisible(loading or bool(self.stats_workers or self.pyramid_workers or self.store_worker or
+                                                 self.tile_prefetcher))
+        self.cancel_button.setVisible(loading)
 
     def download_values(self):
+        import pandas as pd
+
         if not self.element:
             return
         array = pd.DataFrame({'time': self.variables[0].times[:],
-                              **{'{}'.format(var.hdf.model.name): var.get_element(self.element.number).round(3)
+                              **{'{}'.format(var.hdf.model.name): self.element_cache.get(var, self.element.number).round(3)
                                  for var in self.variables}})
 
         directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), '{} at {}.csv'.format(
@@ -413,25 +685,259 @@ class App(QMainWindow):
                                                     self.element.location[0], self.element.location[1]))
             array.to_csv(dialog[0], index=False, mode='a')
 
+    def convert_model(self):
+        from store import StoreWorker
+
+        if self.store_worker is not None:
+            return
+        self.element_stores.discard_model(self.model)
+        self.store_worker = StoreWorker(self.model, parent=self)
+        self.store_worker.progress.connect(self.set_progress)
+        self.store_worker.finished.connect(self.on_converted)
+        self.convert_button.setEnabled(False)
+        self.update_progress()
+        self.store_worker.start()
+
+    def on_converted(self):
+        self.element_stores.discard_model(self.store_worker.model)
+        self.store_worker = None
+        self.convert_button.setEnabled(True)
+        self.update_progress()
+
+    def cache_tiles(self):
+        if self.tile_prefetcher is not None or self.mapCanvas is None or self.mapCanvas.table is None:
+            return
+        if not self.tiles.online:
+            msg = QMessageBox()
+            msg.setText('The basemap cannot be cached while offline')
+            msg.exec_()
+            return
+        self.tile_prefetcher = TilePrefetcher(self.tiles, self.mapCanvas.bounds(),
+                                              range(tile_prefetch_zooms[0], tile_prefetch_zooms[1] + 1), parent=self)
+        self.tile_prefetcher.progress.connect(self.set_progress)
+        self.tile_prefetcher.finished.connect(self.on_tiles_cached)
+        self.cache_tiles_button.setEnabled(False)
+        self.update_progress()
+        self.tile_prefetcher.start()
+
+    def on_tiles_cached(self):
+        prefetcher = self.tile_prefetcher
+        self.tile_prefetcher = None
+        self.cache_tiles_button.setEnabled(True)
+        self.update_progress()
+        if prefetcher.cancelled:
+            return
+        if prefetcher.missing:
+            msg = QMessageBox()
+            msg.setText('Cached {} basemap tiles, {} could not be downloaded'.format(prefetcher.fetched,
+                                                                                      prefetcher.missing))
+            msg.exec_()
+        elif prefetcher.max_zoom != tile_prefetch_zooms[1]:
+            msg = QMessageBox()
+            msg.setText('Cached {} basemap tiles up to zoom level {}, the most the tile server allows to be downloaded '
+                        'for offline use'.format(prefetcher.fetched, prefetcher.max_zoom))
+            msg.exec_()
+
+    def get_stats(self, variable, difference=None):
+        key = (variable.hdf.model, variable.name, difference.hdf.model if difference is not None else None)
+        if key in self.stats:
+            return self.stats[key]
+        if key not in self.stats_workers:
+            from stats import StatsWorker
+            worker = StatsWorker(key, variable, difference, len(self.mapCanvas.visible_rows), parent=self)
+            worker.progress.connect(self.set_progress)
+            worker.calculated.connect(self.on_stats)
+            self.stats_workers[key] = worker
+            self.update_progress()
+            worker.start()
+
+    def on_stats(self, key, stats):
+        worker = self.stats_workers.pop(key, None)
+        if worker is None:
+            return
+        worker.wait()
+        self.stats[key] = stats
+        self.update_progress()
+        self.set_time(self.time)
+
+    def discard_stats(self, model):
+        for key in [key for key in self.stats if model in (key[0], key[2])]:
+            self.stats.pop(key)
+        for key in [key for key in self.stats_workers if model in (key[0], key[2])]:
+            worker = self.stats_workers.pop(key)
+            worker.cancel()
+            worker.wait()
+        for key in [key for key in self.pyramids if key[0] == model]:
+            self.pyramids.pop(key)
+        for key in [key for key in self.pyramid_workers if key[0] == model]:
+            worker = self.pyramid_workers.pop(key)
+            worker.cancel()
+            worker.wait()
+        self.update_progress()
+
+    def get_pyramid(self, variable):
+        key = (variable.hdf.model, variable.name)
+        if key in self.pyramids:
+            return self.pyramids[key]
+        if key not in self.pyramid_workers:
+            from pyramid import PyramidWorker
+            worker = PyramidWorker(key, variable, parent=self)
+            worker.progress.connect(self.set_progress)
+            worker.built.connect(self.on_pyramid)
+            self.pyramid_workers[key] = worker
+            self.update_progress()
+            worker.start()
+
+    def on_pyramid(self, key, pyramid):
+        worker = self.pyramid_workers.pop(key, None)
+        if worker is None:
+            return
+        worker.wait()
+        self.pyramids[key] = pyramid
+        self.update_progress()
+        self.set_time(self.time)
+        if self.resolutionDropDown.currentText() in pyramid:
+            self.update_plot()
+
     def set_time(self, time):
         self.time = time
+        self.scheduler.request()
+
+    def set_map_mode(self):
+        self.set_time(self.time)
+        self.update_plot()
+
+    @traced
+    def render(self):
+        from matplotlib.colors import Normalize
+        from ensemble import Ensemble, modes as ensemble_modes
+        from pyramid import levels as pyramid_levels
+
         if self.differenceDropDown.isEnabled():
             difference = self.variables[self.differenceDropDown.currentIndex()]
         else:
             difference = None
-        self.mapCanvas.set_time(self.time, self.variable, difference=difference)
+
+        mode = self.mapModeDropDown.currentText()
+        variable = self.variable
+        if mode in ensemble_modes:
+            variable = Ensemble(self.variables, mode, self.modelDropDown.currentIndex())
+            difference = None
+
+        values = None
+        if mode in period_modes:
+            difference = None
+            level = self.resolutionDropDown.currentText()
+            if level not in dict(pyramid_levels):
+                # A period needs a resolution, at 'All Timesteps' the periods are days
+                level = pyramid_levels[0][0]
+            pyramid = self.get_pyramid(self.variable)
+            if pyramid is not None and level in pyramid:
+                values = pyramid.frame(level, self.time, period_modes[mode])
+
+        stats = None
+        if mode in ['Mean', 'Maximum'] or \
+                (self.fixedScaleCheckBox.isChecked() and mode in ['Timestep', 'Ensemble Mean'] + list(period_modes)):
+            stats = self.get_stats(self.variable, difference)
+        norm = stats.norm if stats is not None and self.fixedScaleCheckBox.isChecked() else None
+        if mode == 'Ensemble Rank':
+            norm = Normalize(vmin=1, vmax=max(len(self.variables), 2))
+
+        if stats is not None and mode == 'Mean':
+            self.mapCanvas.set_values(stats.mean, norm)
+        elif stats is not None and mode == 'Maximum':
+            self.mapCanvas.set_values(stats.max, norm)
+        elif values is not None:
+            self.mapCanvas.set_values(values, norm)
+        elif mode not in ['Mean', 'Maximum']:
+            self.mapCanvas.set_time(self.time, variable, difference=difference, norm=norm)
+            self.prefetcher.request(variable, self.time, difference, len(self.mapCanvas.visible_rows),
+                                    norm, self.stepSpinBox.value() if self.playback_timer.isActive() else None)
         self.plotCanvas.set_time(self.variable.times[self.time], self.mapCanvas.norm)
         self.legendCanvas.set_time(self.mapCanvas.norm)
+        if self.frame_times is not None:
+            QTimer.singleShot(0, self.show_frame_times)
+
+    def show_frame_times(self):
+        now = clock.perf_counter()
+        if self.frame_clock is not None and now - self.frame_clock < 1:
+            rate = 1 / max(now - self.frame_clock, 1e-6)
+            self.frame_rate = rate if self.frame_rate == 0 else 0.9 * self.frame_rate + 0.1 * rate
+        else:
+            self.frame_rate = 0
+        self.frame_clock = now
+        self.frame_times.setText('Render {:.1f} ms  Map {:.1f} ms  Plot draw {:.1f} ms  {:.1f} fps'.format(
+            1000 * tracer.last.get('App.render', 0), 1000 * tracer.last.get('MapCanvas.set_time', 0),
+            1000 * tracer.last.get('PlotCanvas.draw', 0), self.frame_rate))
+
+    def frames_per_second(self):
+        if self.speedUnitDropDown.currentText() == 'days/s':
+            times = self.variable.times
+            days_per_frame = (times[1] - times[0]).total_seconds() / 86400 * self.stepSpinBox.value()
+            return self.speedSpinBox.value() / days_per_frame
+        return self.speedSpinBox.value()
+
+    def toggle_playback(self):
+        if self.playback_timer.isActive():
+            self.pause()
+        else:
+            if self.time >= self.slider.maximum():
+                self.slider.setValue(0)
+            self.play_button.setText('Pause')
+            self.restart_playback()
+
+    def restart_playback(self):
+        if self.play_button.text() != 'Pause':
+            return
+        self.playback_start = (clock.perf_counter(), self.time)
+        self.playback_timer.start(max(10, int(1000 / self.frames_per_second())))
+
+    def pause(self):
+        self.playback_timer.stop()
+        self.play_button.setText('Play')
+
+    def play_frame(self):
+        start_clock, start_time = self.playback_start
+        step = self.stepSpinBox.value()
+        frames = int((clock.perf_counter() - start_clock) * self.frames_per_second())
+        time = min(start_time + frames * step, self.slider.maximum())
+        if time != self.time:
+            self.slider.setValue(time)
+        if time == self.slider.maximum():
+            self.pause()
+
+    def closeEvent(self, event):
+        self.pause()
+        self.cancel_loading()
+        for worker in [self.prefetcher, self.series_worker]:
+            if worker is not None:
+                worker.stop()
+        for worker in list(self.stats_workers.values()) + list(self.pyramid_workers.values()) + \
+                [self.store_worker, self.tile_prefetcher] + self.loaders:
+            if worker is not None:
+                worker.cancel()
+                worker.wait()
+        self.preloader.wait()
+        self.tile_server.stop()
+        tracer.save()
+        if self.args.startup_report:
+            startup.save(self.args.startup_report)
+        super().closeEvent(event)
 
     def set_model(self):
         self.model = self.models[self.modelDropDown.currentIndex()]
         self.variable = self.variables[self.modelDropDown.currentIndex()]
-        if self.differenceDropDown.isEnabled():
-            self.plotCanvas.update_data()
+        self.observed = self.observed_stores[self.model]
+        self.update_plot()
         self.set_time(self.time)
 
 
 if __name__ == '__main__':
+    startup.mark('Imports')
+    arguments = parse_args()
+    # Lets QtWebEngine be imported after the application is created, when the map is first needed
+    QCoreApplication.setAttribute(Qt.AA_ShareOpenGLContexts)
     app = QApplication(sys.argv)
-    ex = App()
+    startup.mark('Application created')
+    ex = App(arguments)
     sys.exit(app.exec_())
@@ -0,0 +1,17 @@
+import os
+import sys
+import pytest
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, os.path.join(root, 'src'))
+sys.path.insert(0, os.path.join(root, 'benchmarks'))
+
+
+@pytest.fixture(scope='session')
+def synthetic_model(tmp_path_factory):
+    from synthetic import write_synthetic
+    from models import load_model
+
+    library = write_synthetic(str(tmp_path_factory.mktemp('synthetic')), rows=6, columns=5, timesteps=300,
+                              step_hours=12)
+    return load_model(library)
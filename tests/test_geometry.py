@@ -0,0 +1,36 @@
+import numpy as np
+import pytest
+from geometry import SpatialIndex
+
+
+def distances_to(bounds, rows, x, y):
+    xmin = np.minimum(bounds[rows, 0], bounds[rows, 2])
+    xmax = np.maximum(bounds[rows, 0], bounds[rows, 2])
+    ymin = np.minimum(bounds[rows, 1], bounds[rows, 3])
+    ymax = np.maximum(bounds[rows, 1], bounds[rows, 3])
+    return np.hypot(np.maximum(0, np.maximum(xmin - x, x - xmax)), np.maximum(0, np.maximum(ymin - y, y - ymax)))
+
+
+@pytest.mark.parametrize('tolerance', [0, 0.5, 3])
+def test_find_matches_brute_force(tolerance):
+    rng = np.random.RandomState(0)
+    corners = rng.uniform(0, 100, (500, 2))
+    sizes = rng.uniform(0.2, 4, (500, 2))
+    # Corners are stored in either order, as river links run in any direction
+    bounds = np.where(rng.rand(500, 1) < 0.5, np.hstack([corners, corners + sizes]),
+                      np.hstack([corners + sizes, corners]))
+    rows = np.sort(rng.choice(500, 300, replace=False))
+    index = SpatialIndex(bounds, rows, tolerance)
+
+    for x, y in rng.uniform(-5, 105, (2000, 2)):
+        distances = distances_to(bounds, rows, x, y)
+        row = index.find(x, y)
+        if distances.min() > index.tolerance:
+            assert row is None
+        else:
+            assert row in rows
+            assert distances[np.searchsorted(rows, row)] == distances.min()
+
+
+def test_empty_index():
+    assert SpatialIndex(np.zeros((3, 4)), np.array([], dtype=int)).find(1, 1) is None
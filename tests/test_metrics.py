@@ -0,0 +1,46 @@
+import numpy as np
+import pandas as pd
+import pytest
+from metrics import Metrics, names
+
+
+def reference(modelled, observed, start, end):
+    join = pd.merge_asof(modelled.rename('modelled').to_frame(), observed.rename('observed').to_frame(),
+                         left_index=True, right_index=True).dropna()
+    join = join.loc[pd.Timestamp(start) if start else None:pd.Timestamp(end) if end else None]
+    m, o = join.modelled.values, join.observed.values
+    if len(m) < 2:
+        return dict.fromkeys(names, np.nan)
+    r = np.corrcoef(m, o)[0, 1]
+    alpha = m.std() / o.std()
+    beta = m.mean() / o.mean()
+    return {
+        'NSE': 1 - ((m - o) ** 2).sum() / ((o - o.mean()) ** 2).sum(),
+        'KGE': 1 - np.sqrt((r - 1) ** 2 + (alpha - 1) ** 2 + (beta - 1) ** 2),
+        'RMSE': np.sqrt(((m - o) ** 2).mean()),
+        'PBIAS': 100 * (m - o).sum() / o.sum(),
+        'r': r,
+    }
+
+
+@pytest.fixture
+def series():
+    rng = np.random.RandomState(0)
+    times = pd.date_range('2000-01-01', periods=2000, freq='H')
+    observed = pd.Series(20 + 5 * np.sin(np.arange(2000) / 100) + rng.standard_normal(2000), index=times)
+    modelled = pd.Series(observed.values * 1.1 + rng.standard_normal(2000), index=times)
+    modelled.iloc[rng.choice(2000, 50, replace=False)] = np.nan
+    # Observations at irregular times, matched to the modelled steps as of each time
+    observed = observed.iloc[np.sort(rng.choice(2000, 700, replace=False))]
+    observed.index = observed.index - pd.Timedelta(minutes=20)
+    return modelled, observed
+
+
+@pytest.mark.parametrize('start, end', [(None, None), ('2000-01-10', '2000-02-20'), ('2000-03-01 05:00', None),
+                                        (None, '2000-01-01 03:00'), ('2000-02-01', '2000-02-01 01:00')])
+def test_windows_match_reference(series, start, end):
+    modelled, observed = series
+    result = Metrics(modelled, observed).window(start, end)
+    expected = reference(modelled, observed, start, end)
+    for name in names:
+        np.testing.assert_allclose(result[name], expected[name], rtol=1e-8, err_msg=name)
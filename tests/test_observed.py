@@ -0,0 +1,11 @@
+import pandas as pd
+from observed import read_series
+
+
+def test_cache_depends_on_time_format(tmp_path):
+    path = tmp_path / 'gauge.csv'
+    path.write_text('time,flow\n01/02/2000,1.0\n03/04/2000,2.0\n')
+
+    assert read_series(str(path), '%d/%m/%Y').index[0] == pd.Timestamp('2000-02-01')
+    assert read_series(str(path), '%m/%d/%Y').index[0] == pd.Timestamp('2000-01-02')
+    assert read_series(str(path), '%d/%m/%Y').index[0] == pd.Timestamp('2000-02-01')
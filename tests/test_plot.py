@@ -0,0 +1,45 @@
+import numpy as np
+import pandas as pd
+import pytest
+from plot import decimate, decimate_envelope
+
+
+@pytest.fixture
+def series():
+    rng = np.random.RandomState(0)
+    values = np.cumsum(rng.standard_normal(100000))
+    values[rng.choice(100000, 500, replace=False)] = np.nan
+    return pd.Series(values, index=pd.date_range('2000-01-01', periods=100000, freq='H'))
+
+
+@pytest.mark.parametrize('xmin, xmax', [(None, None), ('2001-03-04 05:30', '2005-01-01'), ('2010-01-01', None)])
+def test_decimate_keeps_extremes_of_every_bucket(series, xmin, xmax):
+    result = decimate(series, xmin, xmax, pixels=300)
+
+    # The window is padded by one sample on either side so lines reach the plot edges
+    start = 0 if xmin is None else series.index.searchsorted(pd.Timestamp(xmin)) - 1
+    stop = len(series) if xmax is None else series.index.searchsorted(pd.Timestamp(xmax), 'right') + 1
+    window = series.iloc[start:stop]
+    buckets = np.arange(len(window)) // int(np.ceil(len(window) / 300))
+    grouped = window.groupby(buckets)
+    expected = pd.DatetimeIndex(np.concatenate([window.index[[0, -1]], grouped.idxmin(), grouped.idxmax()])).unique()
+
+    pd.testing.assert_series_equal(result, series[expected.sort_values()])
+    assert len(result) <= 2 * 300 + 2
+
+
+def test_short_windows_are_not_decimated(series):
+    result = decimate(series, '2000-01-02', '2000-01-05', pixels=300)
+    pd.testing.assert_series_equal(result, series['2000-01-01 23:00':'2000-01-05 01:00'])
+
+
+def test_decimate_envelope_keeps_both_bounds(series):
+    lower = series - 1 - series.abs() % 3
+    upper = series + 1 + series.abs() % 5
+    low, high = decimate_envelope(lower, upper, '2001-01-01', '2004-01-01', pixels=200)
+
+    pd.testing.assert_index_equal(low.index, high.index)
+    assert len(low) <= 4 * 200 + 4
+    window = slice(low.index[0], low.index[-1])
+    assert low.min() == lower[window].min() and high.max() == upper[window].max()
+    pd.testing.assert_series_equal(high, upper[low.index])
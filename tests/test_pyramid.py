@@ -0,0 +1,46 @@
+import numpy as np
+import pandas as pd
+import pytest
+import frames
+from pyramid import build, levels, load_pyramid
+
+
+def read_with_gaps(read):
+    # Blank some values so that the runs split across chunks also carry missing data
+    def read_time_chunk(variable, start, stop):
+        values = read(variable, start, stop).astype(float)
+        values[np.arange(start, stop) % 17 == 0, ::3] = np.nan
+        return values
+    return read_time_chunk
+
+
+@pytest.mark.parametrize('name', ['ph_depth', 'ovr_flow'])
+@pytest.mark.parametrize('chunk_size', [7, 64, 1000])
+def test_build_matches_pandas(synthetic_model, monkeypatch, name, chunk_size):
+    variable = next(variable for variable in synthetic_model.hdf.spatial_variables if variable.name == name)
+    monkeypatch.setattr(frames, 'read_time_chunk', read_with_gaps(frames.read_time_chunk))
+    values = frames.read_frames(variable, 0, len(variable.times))
+    frame = pd.DataFrame(values, index=pd.DatetimeIndex(variable.times))
+
+    pyramid = build(variable, chunk_size=chunk_size)
+
+    assert 'Daily' in pyramid
+    for level, frequency in levels:
+        grouped = frame.groupby(frame.index.to_period(frequency))
+        for statistic in ['mean', 'min', 'max']:
+            np.testing.assert_allclose(pyramid.arrays['{}_{}'.format(level, statistic)],
+                                       getattr(grouped, statistic)().values, rtol=1e-6,
+                                       err_msg='{} {}'.format(level, statistic))
+        np.testing.assert_array_equal(pyramid.times(level), grouped.mean().index.end_time.normalize())
+
+
+def test_saved_pyramid_is_memory_mapped(synthetic_model):
+    variable = next(variable for variable in synthetic_model.hdf.spatial_variables if variable.name == 'ph_depth')
+
+    saved = build(variable, chunk_size=64, save=True)
+    loaded = load_pyramid(variable)
+
+    assert isinstance(loaded.arrays['Daily_mean'], np.memmap)
+    for name, array in build(variable, chunk_size=64).arrays.items():
+        np.testing.assert_array_equal(saved.arrays[name], array, err_msg=name)
+        np.testing.assert_array_equal(loaded.arrays[name], array, err_msg=name)
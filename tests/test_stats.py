@@ -0,0 +1,21 @@
+import numpy as np
+from stats import histogram_percentiles, percentiles, bins
+
+
+def test_histogram_percentiles_match_numpy():
+    rng = np.random.RandomState(0)
+    values = np.concatenate([rng.standard_normal((20, 5000)), rng.exponential(2, (20, 5000))])
+    lower, upper = values.min(), values.max()
+    histograms = np.stack([np.histogram(row, bins, (lower, upper))[0] for row in values])
+
+    result = histogram_percentiles(histograms, lower, upper)
+    expected = np.percentile(values, percentiles, axis=1).T
+    np.testing.assert_allclose(result, expected, atol=(upper - lower) / bins)
+
+
+def test_empty_histograms_are_nan():
+    histograms = np.zeros((3, bins), dtype=np.int64)
+    histograms[1, 10] = 4
+    result = histogram_percentiles(histograms, 0, 1)
+    assert np.isnan(result[[0, 2]]).all()
+    np.testing.assert_allclose(result[1], 0.1 + percentiles / 100 * 0.01)